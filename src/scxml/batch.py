@@ -0,0 +1,154 @@
+'''
+This file is part of PySCXML.
+
+    PySCXML is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Lesser General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    PySCXML is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU Lesser General Public License for more details.
+
+    You should have received a copy of the GNU Lesser General Public License
+    along with PySCXML. If not, see <http://www.gnu.org/licenses/>.
+    
+    Filtering of the sessions a MultiSession broadcasts an event to. Only the 
+    fan-out is vectorized: the sessions that receive the event still select and 
+    take their transitions, and run their executable content, one by one.
+'''
+
+from functools import partial
+from interpreter import nameMatch
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# the number of event names whose sensitivity masks are remembered.
+MASK_CACHE_SIZE = 1000
+
+
+class SessionCohort(object):
+    '''
+    The sessions of a MultiSession running the same precompiled document. The
+    configuration of each session is kept as a row of a boolean matrix (or as
+    an integer bitset, if numpy isn't installed), so that the sessions that might
+    react to a broadcast event are found with a single array operation instead
+    of by visiting every session.
+
+    A session might react to an event if one of its active states has a transition
+    matching the event name, an eventless transition with a cond (which is
+    evaluated again after every event) or an autoforwarding invoke. Its configuration 
+    only tells what it will do with the next event if it's waiting on an empty 
+    external queue, so every other session (one that hasn't started, is in a 
+    macrostep or has events queued) is marked busy and always gets the event.
+    '''
+    def __init__(self, doc):
+        self.doc = doc
+        self.states = doc.compiled.module.STATES
+        self.bit = dict((id, i) for i, id in enumerate(self.states))
+        # interpreter -> row
+        self.rows = {}
+        # row -> StateMachine
+        self.sessions = []
+        self.free = []
+        self.masks = {}
+        if numpy:
+            self.matrix = numpy.zeros((16, len(self.states)), dtype=bool)
+            self.busy = numpy.zeros(16, dtype=bool)
+        else:
+            self.bitsets = []
+            self.busyRows = set()
+
+    def __len__(self):
+        return len(self.rows)
+
+    def add(self, sm):
+        if self.free:
+            row = self.free.pop()
+            self.sessions[row] = sm
+        else:
+            row = len(self.sessions)
+            self.sessions.append(sm)
+            if numpy and row == len(self.matrix):
+                self.matrix = numpy.vstack((self.matrix, numpy.zeros(self.matrix.shape, dtype=bool)))
+                self.busy = numpy.concatenate((self.busy, numpy.zeros(len(self.busy), dtype=bool)))
+            elif not numpy:
+                self.bitsets.append(0)
+        self.rows[sm.interpreter] = row
+        sm.interpreter.cohort = self
+        sm.interpreter.externalQueue.onPut = partial(self.setBusy, sm.interpreter, True)
+        self.update(sm.interpreter)
+        self.setBusy(sm.interpreter, True)
+
+    def remove(self, sm):
+        row = self.rows.pop(sm.interpreter, None)
+        if row is None: return
+        sm.interpreter.cohort = None
+        sm.interpreter.externalQueue.onPut = None
+        self.sessions[row] = None
+        if numpy:
+            self.matrix[row] = False
+            self.busy[row] = False
+        else:
+            self.bitsets[row] = 0
+            self.busyRows.discard(row)
+        self.free.append(row)
+
+    def update(self, interpreter):
+        '''Stores the current configuration of interpreter.'''
+        row = self.rows[interpreter]
+        indices = [self.bit[s.id] for s in interpreter.configuration]
+        if numpy:
+            self.matrix[row] = False
+            self.matrix[row, indices] = True
+        else:
+            self.bitsets[row] = sum(1 << i for i in indices)
+
+    def setBusy(self, interpreter, busy):
+        row = self.rows.get(interpreter)
+        if row is None: return
+        if numpy:
+            self.busy[row] = busy
+        elif busy:
+            self.busyRows.add(row)
+        else:
+            self.busyRows.discard(row)
+    
+    def wait(self, interpreter):
+        '''Called by interpreter before it takes an event from its external queue.'''
+        if interpreter.externalQueue.empty():
+            self.setBusy(interpreter, False)
+    
+    def getMask(self, name):
+        '''Returns the states that might react to the event name, as indices or as a bitset.'''
+        if name not in self.masks:
+            if len(self.masks) >= MASK_CACHE_SIZE:
+                self.masks.clear()
+            tokens = name.split(".")
+            indices = []
+            for i, id in enumerate(self.states):
+                state = self.doc.getState(id)
+                if any(t.event and nameMatch(t.event, tokens) or not t.event and t.cond for t in state.transition) \
+                        or any(inv.autoforward for inv in state.invoke):
+                    indices.append(i)
+            self.masks[name] = numpy.array(indices, dtype=int) if numpy else sum(1 << i for i in indices)
+        return self.masks[name]
+
+    def getReceivers(self, name):
+        '''Returns the sessions of this cohort that might react to the event name.'''
+        mask = self.getMask(name)
+        n = len(self.sessions)
+        if numpy:
+            hits = self.busy[:n].copy()
+            if len(mask):
+                hits |= self.matrix[:n, mask].any(axis=1)
+            return [self.sessions[row] for row in numpy.flatnonzero(hits)]
+        return [sm for row, (sm, bits) in enumerate(zip(self.sessions, self.bitsets)) 
+                if bits & mask or row in self.busyRows]
+
+
+__all__ = ["SessionCohort"]
@@ -0,0 +1,306 @@
+'''
+This file is part of PySCXML.
+
+    PySCXML is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Lesser General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    PySCXML is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU Lesser General Public License for more details.
+
+    You should have received a copy of the GNU Lesser General Public License
+    along with PySCXML. If not, see <http://www.gnu.org/licenses/>.
+
+    Ahead-of-time compilation of SCXMLDocument instances into plain Python
+    modules. The generated module holds one transition selection function per
+    atomic state, with the event descriptors of the state and its ancestors
+    hard-coded, and the exit and entry sets of each transition resolved in advance.
+    Executable content and conds are still run by the Compiler and the datamodel.
+    
+    Documents without parallel or history states, conds and invokes are flagged 
+    as flat: their configuration is determined by a single atomic state, so the 
+    transition taken for an event depends only on that state and the event name, 
+    and can be looked up in a table (see Interpreter.flatEventLoop). A flat 
+    document may still have a datamodel and executable content (<assign>, 
+    <script> etc), since only conds take part in the selection of transitions; 
+    the content is run by the Compiler as usual.
+'''
+
+import os
+import imp
+import hashlib
+import logging
+
+from node import History
+from datastructures import OrderedSet
+from interpreter import Interpreter, isAtomicState, isHistoryState, isDescendant, isParallelState
+
+# bump this whenever the layout of the generated modules changes.
+CODEGEN_VERSION = 4
+
+# the size at which the table of a flat document is reset.
+FLAT_TABLE_SIZE = 10000
+
+logger = logging.getLogger("pyscxml.codegen")
+
+# generated modules, by document hash.
+_modules = {}
+
+
+class CompiledDocument(object):
+    '''
+    Binds a generated module to the transitions and states of an SCXMLDocument
+    parsed from the same source.
+    '''
+    def __init__(self, module, doc):
+        self.module = module
+        self.doc = doc
+        self.transitions = [doc.getState(source).transition[n] for source, n in module.TRANSITIONS]
+        self.index = dict((t, i) for i, t in enumerate(self.transitions))
+        self.entries = []
+        for entry in module.ENTRY:
+            if entry is not None:
+                statesToEnter, defaultEntry = entry
+                entry = (map(doc.getState, statesToEnter), frozenset(map(doc.getState, defaultEntry)))
+            self.entries.append(entry)
+        self.isFlat = module.FLAT
+
+    def selectTransitions(self, atomicStates, tokens, conditionMatch):
+        cond = lambda i: conditionMatch(self.transitions[i])
+        enabledTransitions = OrderedSet()
+        for state in atomicStates:
+            i = self.module.SELECT[state.id](tokens, cond)
+            if i is not None:
+                enabledTransitions.add(self.transitions[i])
+        return enabledTransitions
+
+    def selectEventlessTransitions(self, atomicStates, conditionMatch):
+        cond = lambda i: conditionMatch(self.transitions[i])
+        enabledTransitions = OrderedSet()
+        for state in atomicStates:
+            i = self.module.EVENTLESS[state.id](cond)
+            if i is not None:
+                enabledTransitions.add(self.transitions[i])
+        return enabledTransitions
+
+    def getStatesToExit(self, enabledTransitions, configuration):
+        '''Returns None if the exit set of any of the transitions wasn't resolved in advance.'''
+        scopes = []
+        for t in enabledTransitions:
+            i = self.index.get(t)
+            if i is None or self.module.EXIT_SCOPE[i] is None:
+                return None
+            scopes.append(self.module.EXIT_SCOPE[i])
+        return OrderedSet(s for s in configuration if any(s.id in scope for scope in scopes))
+
+    def getFlatTransition(self, state, name):
+        '''
+        Returns the transition taken from the atomic state by the event name 
+        (or the eventless transition, if name is None) in a flat document. 
+        The table is filled in as new (state, event name) pairs are seen and 
+        is shared by every session running the document.
+        '''
+        key = (state.id, name)
+        table = self.module.FLAT_TABLE
+        if key not in table:
+            if len(table) >= FLAT_TABLE_SIZE:
+                table.clear()
+            # flat documents have no conds.
+            if name is None:
+                table[key] = self.module.EVENTLESS[state.id](None)
+            else:
+                table[key] = self.module.SELECT[state.id](tuple(name.split(".")), None)
+        i = table[key]
+        return self.transitions[i] if i is not None else None
+    
+    def getStatesToEnter(self, t):
+        '''Returns None if the entry set of t depends on a history state.'''
+        i = self.index.get(t)
+        if i is None:
+            return None
+        return self.entries[i]
+
+
+class EntryPlanner(Interpreter):
+    '''Resolves the exit and entry sets of transitions that don't depend on the configuration.'''
+    def __init__(self, doc):
+        Interpreter.__init__(self)
+        self.doc = doc
+        self.usesHistory = False
+
+    def addStatesToEnter(self, state, statesToEnter, statesForDefaultEntry):
+        if isHistoryState(state):
+            self.usesHistory = True
+        Interpreter.addStatesToEnter(self, state, statesToEnter, statesForDefaultEntry)
+
+    def getExitScope(self, t):
+        if not t.target:
+            return frozenset()
+        domain = self.getTransitionDomain(t)
+        return frozenset(s.id for s in self.doc if isDescendant(s, domain))
+
+    def getEntry(self, t):
+        self.usesHistory = False
+        statesToEnter, statesForDefaultEntry = self.getStatesToEnter([t])
+        if self.usesHistory:
+            return None
+        return (tuple(s.id for s in statesToEnter),
+                tuple(s.id for s in statesToEnter if s in statesForDefaultEntry))
+
+
+def generate(doc):
+    '''Returns the source code of the Python module for the SCXMLDocument doc.'''
+    planner = EntryPlanner(doc)
+    states = [s for s in doc if not isinstance(s, History)]
+
+    transitions = []
+    for state in states:
+        for n, t in enumerate(state.transition):
+            transitions.append((state, n, t))
+    number = dict((t, i) for i, (state, n, t) in enumerate(transitions))
+
+    lines = [
+        "# Generated by scxml.codegen from the document %r. Do not edit." % doc.name,
+        "",
+        "CODEGEN_VERSION = %r" % CODEGEN_VERSION,
+        "",
+        "FLAT = %r" % isFlat(doc),
+        "# (atomic state id, event name) -> transition number, filled in at runtime",
+        "FLAT_TABLE = {}",
+        "",
+        "# the state ids, in document order",
+        "STATES = %r" % [s.id for s in states],
+        "",
+        "# (source state id, index among the transitions of the source state)",
+        "TRANSITIONS = [",
+    ]
+    for i, (state, n, t) in enumerate(transitions):
+        lines.append("    (%r, %r), # %s" % (state.id, n, i))
+    lines.append("]")
+
+    exitScopes = []
+    entries = []
+    for state, n, t in transitions:
+        try:
+            exitScopes.append(planner.getExitScope(t))
+            entries.append(planner.getEntry(t))
+        except Exception, e:
+            # e.g a missing target, which should fail when the transition is taken.
+            logger.debug("Transition %s was not resolved: %s" % (t, e))
+            exitScopes.append(None)
+            entries.append(None)
+
+    lines.append("")
+    lines.append("# the ids of the states a transition may exit")
+    lines.append("EXIT_SCOPE = [")
+    for scope in exitScopes:
+        lines.append("    %s," % (repr(scope) if scope is None else "frozenset(%r)" % sorted(scope)))
+    lines.append("]")
+    lines.append("")
+    lines.append("# (ids of the states entered in entry order, ids of the states entered by default)")
+    lines.append("ENTRY = [")
+    for entry in entries:
+        lines.append("    %r," % (entry,))
+    lines.append("]")
+
+    select = []
+    eventless = []
+    for state in filter(isAtomicState, states):
+        ancestry = [state]
+        while ancestry[-1].parent:
+            ancestry.append(ancestry[-1].parent)
+
+        lines.append("")
+        lines.append("def _select_%s(tokens, cond):" % state.n)
+        for s in ancestry:
+            lines.append("    # %r" % s.id)
+            for t in s.transition:
+                if not t.event: continue
+                lines.append("    if %s:" % " or ".join(descriptorTest(d) for d in t.event))
+                lines.append("        %s" % returnStatement(t, number[t]))
+        lines.append("    return None")
+        select.append((state.id, "_select_%s" % state.n))
+
+        lines.append("")
+        lines.append("def _eventless_%s(cond):" % state.n)
+        for s in ancestry:
+            lines.append("    # %r" % s.id)
+            for t in s.transition:
+                if t.event: continue
+                lines.append("    %s" % returnStatement(t, number[t]))
+        lines.append("    return None")
+        eventless.append((state.id, "_eventless_%s" % state.n))
+
+    lines.append("")
+    lines.append("SELECT = {")
+    lines.extend("    %r : %s," % pair for pair in select)
+    lines.append("}")
+    lines.append("")
+    lines.append("EVENTLESS = {")
+    lines.extend("    %r : %s," % pair for pair in eventless)
+    lines.append("}")
+    lines.append("")
+
+    return "\n".join(lines)
+
+def isFlat(doc):
+    '''
+    True if doc has no parallel or history states, no conds and no invokes. 
+    The datamodel and executable content don't matter, see the module docstring.
+    '''
+    for s in doc:
+        if isParallelState(s) or s.history or s.invoke:
+            return False
+        if any(t.cond for t in s.transition):
+            return False
+    return True
+
+def descriptorTest(descriptor):
+    if descriptor == ["*"]:
+        return "True"
+    return "tokens[:%s] == %r" % (len(descriptor), tuple(descriptor))
+
+def returnStatement(t, i):
+    if t.cond:
+        return "if cond(%s): return %s" % (i, i)
+    return "return %s" % i
+
+
+def load(doc, xml, cache_dir=None):
+    '''
+    Returns a CompiledDocument for doc, which must be the SCXMLDocument parsed from
+    the string xml. The generated module is kept in memory for as long as the
+    process runs, and if cache_dir (or the PYSCXMLCACHE environment variable) is
+    set, it's written to that directory as an importable module as well.
+    '''
+    if isinstance(xml, unicode): xml = xml.encode("utf-8")
+    key = hashlib.sha1(xml).hexdigest()
+    if key not in _modules:
+        _modules[key] = importModule(doc, key, cache_dir or os.environ.get("PYSCXMLCACHE"))
+    return CompiledDocument(_modules[key], doc)
+
+def importModule(doc, key, cache_dir=None):
+    name = "scxml_%s" % key
+    if not cache_dir:
+        module = imp.new_module(name)
+        exec compile(generate(doc), "<%s>" % name, "exec") in module.__dict__
+        return module
+
+    path = os.path.join(cache_dir, name + ".py")
+    if os.path.isfile(path):
+        module = imp.load_source(name, path)
+        if getattr(module, "CODEGEN_VERSION", None) == CODEGEN_VERSION:
+            return module
+        logger.info("Regenerating the outdated module %s" % path)
+
+    tmp = "%s.%s.tmp" % (path, os.getpid())
+    with open(tmp, "w") as f:
+        f.write(generate(doc))
+    os.rename(tmp, path)
+    return imp.load_source(name, path)
+
+
+__all__ = ["CompiledDocument", "generate", "isFlat", "load"]
@@ -23,10 +23,10 @@ from node import *
 import re, sys
 from functools import partial
 from messaging import UrlGetter, get_path
-from louie import dispatcher
+import messaging
 from urllib2 import URLError
 from eventlet.green.urllib2 import urlopen #@UnresolvedImport
-from eventprocessor import Event, SCXMLEventProcessor as Processor, ScxmlMessage
+from eventprocessor import Event, SCXMLEventProcessor as Processor, ScxmlMessage, internToken
 from invoke import *
 from xml.parsers.expat import ExpatError
 #from xml.etree import ElementTree as etree
@@ -37,6 +37,7 @@ import time
 from datamodel import *
 from errors import *
 from eventlet import Queue
+from eventqueue import Full
 import scxml.pyscxml
 from datastructures import xpathparser
 import eventlet
@@ -58,6 +59,7 @@ ns = "http://www.w3.org/2005/07/scxml"
 pyscxml_ns = "http://code.google.com/p/pyscxml"
 tagsForTraversal = ["scxml", "state", "parallel", "history", "final", "transition", "invoke", "onentry", "onexit", "datamodel"]
 tagsForTraversal = map(prepend_ns, tagsForTraversal)
+stateTags = map(prepend_ns, ["scxml", "state", "parallel", "final"])
 custom_exec_mapping = {}
 preprocess_mapping = {}
 datamodel_mapping = {
@@ -87,6 +89,15 @@ class Compiler(object):
 #        self.sourceline_mapping = {}
         
         self.log_function = None
+        # a scxml.logsink.LogSink, which replaces log_function if set.
+        self.log_sink = None
+        # a scxml.profiler.Profiler, if the time spent in executable content, conds 
+        # and invokes should be counted.
+        self.profiler = None
+        # a scxml.tracer.Tracer, if blocks of executable content and sends should be traced.
+        self.tracer = None
+        # a scxml.watchdog.Watchdog, if blocks of executable content holding the hub should be reported.
+        self.watchdog = None
         self.strict_parse = False
         self.timer_mapping = {}
         self.instantiate_datamodel = None
@@ -149,6 +160,9 @@ class Compiler(object):
         
     
     def try_execute_content(self, parent):
+        start = time.time() if self.profiler or self.tracer else None
+        if self.watchdog:
+            self.watchdog.enter(split_ns(parent)[1], self.dm.sessionid, parent.sourceline)
         try:
             self.do_execute_content(parent)
         except SendError, e:
@@ -163,6 +177,33 @@ class Compiler(object):
         except Exception, e:
             self.logger.exception("An unknown error occurred when executing content in block on line %s." % parent.sourceline)
             self.raiseError("error.execution", e)
+        if self.watchdog:
+            self.checkTimeout(parent)
+        if start is not None:
+            self.profile(split_ns(parent)[1], parent, start)
+    
+    def checkTimeout(self, node):
+        '''Leaves the watchdog activity of node, raising error.execution.timeout if it took too long.'''
+        elapsed = self.watchdog.leave()
+        if elapsed > self.watchdog.threshold and self.watchdog.timeoutError:
+            msg = "Line %s: %s held the hub for %.3f s." % (node.sourceline, split_ns(node)[1], elapsed)
+            self.logger.error(msg)
+            self.raiseError("error.execution.timeout", TimeoutError(msg))
+    
+    def profile(self, kind, node, start):
+        '''Adds the time since start to the counter of node in self.profiler, and a span to self.tracer.'''
+        if self.profiler:
+            self.profiler.record((self.doc.name, kind, getStateId(node), node.sourceline), time.time() - start)
+        if self.tracer:
+            self.tracer.span(kind, self.dm.sessionid, start, {"state" : getStateId(node), "line" : node.sourceline})
+    
+    def traceSend(self, sender, args):
+        '''Calls sender, recording a span in self.tracer.'''
+        start = time.time()
+        try:
+            return sender()
+        finally:
+            self.tracer.span("send", self.dm.sessionid, start, args)
             
     
     def do_execute_content(self, parent):
@@ -176,7 +217,11 @@ class Compiler(object):
             if node_ns == ns: 
                 if node_name == "log":
                     try:
-                        self.log_function(node.get("label"), self.getExprValue(node.get("expr")))
+                        value = self.getExprValue(node.get("expr"))
+                        if self.log_sink:
+                            self.log_sink.put(self.dm.sessionid, getStateId(node), node.get("label"), value)
+                        else:
+                            self.log_function(node.get("label"), value)
                     except ExprEvalError, e:
                         raise AttributeEvalError(e, node, "expr")
                 elif node_name == "raise":
@@ -210,11 +255,16 @@ class Compiler(object):
                     except Exception, e:
                         raise ExecutableError(AtomicError(e), node)
                 elif node_name == "script":
+                    if self.watchdog:
+                        self.watchdog.enter("script", self.dm.sessionid, node.sourceline)
                     try:
                         src = node.text or self.script_src.get(node) or ""
                         self.execExpr(src)
                     except ExprEvalError, e:
                         raise ExecutableError(e, node)
+                    finally:
+                        if self.watchdog:
+                            self.watchdog.leave()
                         
                 elif node_name == "if":
                     self.parseIf(node)
@@ -314,7 +364,13 @@ class Compiler(object):
                                           "element for documents in a MultiSession enviroment")
             elif node_ns in custom_exec_mapping:
                 # execute functions registered using scxml.pyscxml.custom_executable
-                custom_exec_mapping[node_ns](node, self.dm)
+                if self.watchdog:
+                    self.watchdog.enter("custom executable", self.dm.sessionid, node.sourceline)
+                try:
+                    custom_exec_mapping[node_ns](node, self.dm)
+                finally:
+                    if self.watchdog:
+                        self.watchdog.leave()
                 
             else:
                 if self.strict_parse: 
@@ -478,9 +534,13 @@ class Compiler(object):
                 if self.dm["_ioprocessors"]["scxml"]["location"].startswith("http://"):
                     origin = self.dm["_ioprocessors"]["scxml"]["location"]
                 
-                eventXML = Processor.toxml(eventstr, target, data, origin, sendNode.get("id", ""))
+                message, contentType = Processor.encode(eventstr, target, data, origin, sendNode.get("id", ""), 
+                                                        content_type=messaging.scxmlContentType)
                 getter = self.getUrlGetter()
-                sender = partial(getter.get_async, target, eventXML, content_type="text/xml")
+                if messaging.sendBatcher and not messaging.usesProxy(target):
+                    sender = partial(messaging.sendBatcher.send, target, message, getter, content_type=contentType)
+                else:
+                    sender = partial(getter.get_async, target, message, content_type=contentType)
                 
             else:
                 raise SendExecutionError("The send target '%s' is malformed or unsupported" 
@@ -491,20 +551,20 @@ class Compiler(object):
 #            getter = self.getUrlGetter()
             
             if sendNode.get("httpResponse") in ("true", "True"):
-                def success(signal, *args, **kwargs):
+                def success(sender, **kwargs):
                     code = kwargs["code"]
                     self.interpreter.send("HTTP.%s.%s" % (str(code)[0], str(code)[1:]))
                 
-                def fail(signal, *args, **kwargs):
+                def fail(sender, **kwargs):
                     code = kwargs["exception"].code
                     self.interpreter.send("HTTP.%s.%s" % (str(code)[0], str(code)[1:]))
                     
-                def url_fail(signal, *args, **kwargs):
+                def url_fail(sender, **kwargs):
                     self.logger.error("UrlError: Could not reach target '%s'. \n%s" % (target, kwargs["exception"]))
             
-                dispatcher.connect(success, UrlGetter.HTTP_RESULT, getter, False)
-                dispatcher.connect(fail, UrlGetter.HTTP_ERROR, getter, False)
-                dispatcher.connect(url_fail, UrlGetter.URL_ERROR, getter, False)
+                getter.connect(UrlGetter.HTTP_RESULT, success)
+                getter.connect(UrlGetter.HTTP_ERROR, fail)
+                getter.connect(UrlGetter.URL_ERROR, url_fail)
             origin = "unreachable"
             
 #            TODO: can this be expressed more generally using lxml.objectify?
@@ -562,12 +622,16 @@ class Compiler(object):
             raise SendExecutionError("delay format error: the delay attribute should be " 
             "specified using the CSS time format, you supplied the faulty value: %s" % delay)
              
+        if self.tracer:
+            sender = partial(self.traceSend, sender, {"event" : eventstr, "target" : str(target or ""), "type" : type})
         #TOOD: check for communication errors here. consider using the sender as a async worker.
         if delay:
             self.timer_mapping[sendid] = eventlet.spawn_after(delay, sender)
         else:
             try:
                 sender()
+            except Full:
+                raise SendCommunicationError("The event queue of the target session is full.")
             except Exception, e:
                 raise SendExecutionError("%s: %s" % (e.__class__, e))
         
@@ -575,21 +639,21 @@ class Compiler(object):
     def getUrlGetter(self):
         getter = UrlGetter()
         
-        dispatcher.connect(self.onHttpResult, UrlGetter.HTTP_RESULT, getter)
-        dispatcher.connect(self.onHttpError, UrlGetter.HTTP_ERROR, getter)
-        dispatcher.connect(self.onURLError, UrlGetter.URL_ERROR, getter)
+        getter.connect(UrlGetter.HTTP_RESULT, self.onHttpResult)
+        getter.connect(UrlGetter.HTTP_ERROR, self.onHttpError)
+        getter.connect(UrlGetter.URL_ERROR, self.onURLError)
         
         return getter
 
-    def onHttpError(self, signal, error_code, source, exception, **named ):
-        self.logger.error("A code %s HTTP error has ocurred when trying to send to target %s" % (error_code, source))
+    def onHttpError(self, sender, exception, **named ):
+        self.logger.error("A code %s HTTP error has ocurred when trying to send to target %s" % (exception.code, exception.filename))
         self.interpreter.send("error.communication", data=exception)
 
-    def onURLError(self, signal, sender, exception, url):
+    def onURLError(self, sender, exception, url):
         self.logger.error("The address %s is currently unavailable" % url)
         self.interpreter.send("error.communication", data=exception)
         
-    def onHttpResult(self, signal, **named):
+    def onHttpResult(self, sender, **named):
         self.logger.debug("onHttpResult " + str(named))
     
     def raiseError(self, err, exception=None, sendid=None):
@@ -700,17 +764,29 @@ class Compiler(object):
                 if node.get("target"):
                     t.target = node.get("target").split(" ")
                 if node.get("event"):
-                    t.event = map(lambda x: re.sub(r"(.*)\.\*$", r"\1", x).split("."), node.get("event").split(" "))
+                    t.event = [map(internToken, re.sub(r"(.*)\.\*$", r"\1", x).split(".")) for x in node.get("event").split(" ")]
+                    self.doc.eventDescriptors.update(map(tuple, t.event))
                 if node.get("cond"):
-                    def f(expr):
+                    def f(expr, compiled, node):
+                        start = time.time() if self.profiler or self.tracer else None
                         try:
-                            return self.getExprValue(expr)
+                            return self.getExprValue(compiled)
                         except Exception, e:
                             self.raiseError("error.execution", e)
                             self.logger.error("Evaluation of cond failed on line %s: %s" % (node.sourceline, expr))
+                        finally:
+                            if start is not None:
+                                self.profile("cond", node, start)
                         
-                    
-                    t.cond = partial(f, node.get("cond"))
+                    cond = node.get("cond")
+                    t.condExpr = self.dm.compileExpr(cond) if hasattr(self.dm, "compileExpr") else cond
+                    t.cond = partial(f, cond, t.condExpr, node)
+                    if hasattr(self.dm, "getDependencies"):
+                        t.condDeps = self.dm.getDependencies(cond)
+                        t.condPure = t.condDeps is not None and self.dm.isPure(cond)
+                    if not node.get("event") and (t.condDeps is None or "_event" in t.condDeps):
+                        # an eventless transition might be enabled by any new _event.
+                        self.doc.eventDescriptors.add(("*",))
                 t.type = node.get("type", "external") 
                 
                 t.exe = partial(self.try_execute_content, node)
@@ -758,40 +834,50 @@ class Compiler(object):
     def make_invoke_wrapper(self, node, parentId, n):
         
         def start_invoke(wrapper):
+            start = time.time() if self.profiler or self.tracer else None
             try:
-                inv = self.parseInvoke(node, parentId, n)
-            except InvokeError, e:
-                self.logger.exception("Line %s: Exception while parsing invoke." % (node.sourceline))
-                self.raiseError("error.execution.invoke.parseerror", e )
-                return
-            except Exception, e:
-                self.logger.exception("Line %s: Exception while parsing invoke." % (node.sourceline))
-                self.raiseError("error.execution.invoke." + type(e).__name__.lower(), e)
-                return
-            wrapper.set_invoke(inv)
-            
-            dispatcher.connect(self.onInvokeSignal, "init.invoke." + inv.invokeid, inv)
-            dispatcher.connect(self.onInvokeSignal, "result.invoke." + inv.invokeid, inv)
-            dispatcher.connect(self.onInvokeSignal, "error.communication.invoke." + inv.invokeid, inv)
-            try:
-                if isinstance(inv, InvokeSCXML):
-                    def onCreated(sender, sm):
-                        sessionid = sm.sessionid
-                        self.dm.sessions.make_session(sessionid, sm)
-#                        self.dm["_x"]["sessions"][sessionid] = inv
-                    dispatcher.connect(onCreated, "created", inv, weak=False)
-                inv.start(self.dm.sessionid)
-            except Exception, e:
-#                del self.dm["_x"]["sessions"][sessionid]
-                self.logger.exception("Line %s: Exception while parsing invoke xml." % (node.sourceline))
-                self.raiseError("error.execution.invoke." + type(e).__name__.lower(), e)
+                self.do_start_invoke(wrapper, node, parentId, n)
+            finally:
+                if start is not None:
+                    self.profile("invoke", node, start)
             
         wrapper = InvokeWrapper()
         wrapper.invoke = start_invoke
         wrapper.autoforward = node.get("autoforward", "false").lower() == "true"
+        if wrapper.autoforward:
+            self.doc.eventDescriptors.add(("*",))
         
         return wrapper
     
+    def do_start_invoke(self, wrapper, node, parentId, n):
+        '''Parses and starts the invoke element node, on behalf of wrapper.'''
+        try:
+            inv = self.parseInvoke(node, parentId, n)
+        except InvokeError, e:
+            self.logger.exception("Line %s: Exception while parsing invoke." % (node.sourceline))
+            self.raiseError("error.execution.invoke.parseerror", e )
+            return
+        except Exception, e:
+            self.logger.exception("Line %s: Exception while parsing invoke." % (node.sourceline))
+            self.raiseError("error.execution.invoke." + type(e).__name__.lower(), e)
+            return
+        wrapper.set_invoke(inv)
+        
+        for signal in ("init.invoke.", "result.invoke.", "error.communication.invoke."):
+            inv.connect(signal + inv.invokeid, partial(self.onInvokeSignal, signal + inv.invokeid))
+        try:
+            if isinstance(inv, InvokeSCXML):
+                def onCreated(sender, sm):
+                    sessionid = sm.sessionid
+                    self.dm.sessions.make_session(sessionid, sm)
+#                        self.dm["_x"]["sessions"][sessionid] = inv
+                inv.connect("created", onCreated)
+            inv.start(self.dm.sessionid)
+        except Exception, e:
+#                del self.dm["_x"]["sessions"][sessionid]
+            self.logger.exception("Line %s: Exception while parsing invoke xml." % (node.sourceline))
+            self.raiseError("error.execution.invoke." + type(e).__name__.lower(), e)
+    
     def onInvokeSignal(self, signal, sender, **kwargs):
         self.logger.debug("onInvokeSignal " + signal)
         if signal.startswith("error"):
@@ -822,6 +908,7 @@ class Compiler(object):
         scxmlType = ["http://www.w3.org/TR/scxml", "scxml"]
         if invtype.strip("/") in scxmlType: 
             inv = InvokeSCXML(dict(data))
+            inv.log_sink = self.log_sink
             contentNode = node.find(prepend_ns("content"))
             if contentNode != None:
                 cnt = self.parseContent(contentNode)
@@ -1009,6 +1096,12 @@ def preprocess(tree):
             node.set('id',id)
             
             
+def getStateId(node):
+    '''Returns the id of the state containing the executable element node.'''
+    while node is not None and node.tag not in stateTags:
+        node = node.getparent()
+    return node.get("id") if node is not None else None
+
 #TODO: this should be moved to the python datamodel class.
 def normalizeExpr(expr):
     return textwrap.dedent(expr)
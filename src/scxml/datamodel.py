@@ -6,6 +6,7 @@ Created on Nov 1, 2011
 import sys
 import traceback
 import re
+import ast
 from lxml import etree, objectify
 from copy import deepcopy
 from scxml.datastructures import dictToXML
@@ -23,6 +24,9 @@ except:
 
 assignOnce = ["_sessionid", "_x", "_name", "_ioprocessors"]
 hidden = ["_event"]
+# values of these types can only change by being rebound in the datamodel.
+immutableTypes = (int, long, float, complex, bool, basestring, type(None))
+_unbound = object()
 
 
 def getTraceback():
@@ -94,12 +98,16 @@ class PythonDataModel(dict, ImperativeDataModel):
     '''The default Python Datamodel'''    
     def __init__(self, *args, **kwargs):
         dict.__init__(self, *args, **kwargs)
+        # incremented on every write to the datamodel.
+        self.version = 0
+        self.compiled = {}
     
     def __setitem__(self, key, val):
         if (key in assignOnce and key in self) or key in hidden or not self.isLegalName(key):
             raise DataModelError("You can't assign to the name '%s'." % key)
         else:
             dict.__setitem__(self, key, val)
+            self.version += 1
     
     def __getitem__(self, key):
         #raises keyerror
@@ -119,6 +127,63 @@ class PythonDataModel(dict, ImperativeDataModel):
         #TODO: what about reserved names?
         return bool(re.match("[a-zA-Z_][0-9a-zA-Z_]*", name))
     
+    def compileExpr(self, expr):
+        '''
+        Returns expr compiled for use with evalExpr. Identical expressions 
+        share the same code object. If expr doesn't compile, it's returned 
+        as is, so that the error is raised when it's evaluated.
+        '''
+        if expr not in self.compiled:
+            try:
+                # like eval, ignore leading whitespace.
+                self.compiled[expr] = compile(expr.lstrip(" \t"), "<string>", "eval")
+            except SyntaxError:
+                return expr
+        return self.compiled[expr]
+    
+    def getDependencies(self, expr):
+        '''
+        Returns a tuple of the names read by the expression expr, 
+        or None if the expression can't be parsed.
+        '''
+        try:
+            tree = ast.parse(expr.strip(), mode="eval")
+        except SyntaxError:
+            return None
+        return tuple(sorted(set(node.id for node in ast.walk(tree) if isinstance(node, ast.Name))))
+    
+    def isPure(self, expr):
+        '''
+        True if evaluating the expression expr can't have side effects, as far as 
+        can be told: it parses, and calls no function other than In. List 
+        comprehensions are excluded too, since they bind their variable.
+        '''
+        try:
+            tree = ast.parse(expr.strip(), mode="eval")
+        except SyntaxError:
+            return False
+        for node in ast.walk(tree):
+            if isinstance(node, ast.ListComp):
+                return False
+            if isinstance(node, ast.Call) and not (isinstance(node.func, ast.Name) and node.func.id == "In"):
+                return False
+        return True
+    
+    def getSnapshot(self, names):
+        '''
+        Returns the values currently bound to names, or None if any 
+        of them could change without being reassigned (i.e is mutable). 
+        Unbound names, like builtins, are included as a placeholder.
+        '''
+        snapshot = []
+        for name in names:
+            if name in hidden: name = "_" + name
+            val = dict.get(self, name, _unbound)
+            if val is not _unbound and not isinstance(val, immutableTypes):
+                return None
+            snapshot.append(val)
+        return snapshot
+    
     def assign(self, assignNode):
         if not self.hasLocation(assignNode.get("location")):
             msg = "The location expression '%s' was not instantiated in the datamodel." % assignNode.get("location")
@@ -278,7 +343,7 @@ class XPathDatamodel(object):
         if key in assignOnce and key in self:
             raise DataModelError("The field '%s' is read only." % key)
         if type(val).__name__ == "Event":
-            val = val.__dict__
+            val = val.toDict()
         
         if type(val) == dict:
             data = dictToXML(val, root="data", root_attrib={"id" : key})
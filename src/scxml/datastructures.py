@@ -128,8 +128,8 @@ if __name__ == '__main__':
           <book title="title2"/>
         </books>
         ''', parser=xpathparser).xpath(".")
-    print xpathData, Event("hello", data=xpathData).__dict__
-    print etree.tostring( dictToXML(Event("hello", data=xpathData).__dict__, root="data", root_attrib={"id" : "key"}), pretty_print=True)
+    print xpathData, Event("hello", data=xpathData).toDict()
+    print etree.tostring( dictToXML(Event("hello", data=xpathData).toDict(), root="data", root_attrib={"id" : "key"}), pretty_print=True)
     sys.exit()
 #    e = Event("hello", data={"d1" : etree.fromstring("<elem/>")})
     e = Event("hello", data={"d1" : 123})
@@ -75,6 +75,9 @@ class AttributeEvalError(CompositeError):
         
 
 
+class TimeoutError(AtomicError):
+    pass
+
 class ParseError(PySCXMLError):
     pass
 
@@ -7,8 +7,14 @@ Created on Dec 6, 2010
 
 import xml.etree.ElementTree as etree
 
+import json
 import pickle
 
+# the content types of the encodings of SCXML messages. A message in JSON is a 
+# single line, so several of them may be sent in one request, a line each.
+XML_CONTENT_TYPE = "text/xml"
+JSON_CONTENT_TYPE = "application/x-scxml+json"
+
 
 class SCXMLEventProcessor(object):
     @staticmethod
@@ -40,7 +46,6 @@ class SCXMLEventProcessor(object):
                 if language == "python":
                     b.data(pickle.dumps(v))
                 elif language == "json":
-                    import json
                     b.data(json.dumps(v))
             else:
                 b.data(v)
@@ -55,26 +60,92 @@ class SCXMLEventProcessor(object):
         
         return etree.tostring(root)
     
+    @staticmethod
+    def tojson(event, target, data, origin="", sendid=""):
+        '''
+        The JSON equivalent of toxml: outputs the message as a single line holding 
+        a JSON object with the name, target, origin, sendid and data of the event. 
+        Raises TypeError if data can't be written as JSON. The strings of the 
+        message are read back as UTF-8 encoded str, but other values may not come 
+        back as they were written (e.g tuples are read as lists and the keys of 
+        dicts as strings); see isExactJson.
+        '''
+        return json.dumps({"name" : event, 
+                           "target" : target, 
+                           "origin" : origin, 
+                           "sendid" : sendid, 
+                           "data" : data}, separators=(",", ":"))
+    
+    @staticmethod
+    def fromjson(jsonstr, origintype="scxml"):
+        '''
+        Takes one or more SCXML messages in JSON, one per line, and outputs 
+        a list of the equivalent scxml.eventprocessor.Event objects.
+        '''
+        return [SCXMLEventProcessor.fromdict(json.loads(line), origintype) 
+                for line in jsonstr.splitlines() if line.strip()]
+    
+    @staticmethod
+    def fromdict(msg, origintype="scxml"):
+        '''
+        Takes an SCXML message read from JSON and outputs the equivalent Event, 
+        with its strings encoded as UTF-8 str.
+        '''
+        msg = encodeStrings(msg)
+        event = Event(msg["name"], msg.get("data") or {})
+        event.origin = msg.get("origin")
+        event.sendid = msg.get("sendid")
+        event.origintype = origintype
+        return event
+    
+    @staticmethod
+    def encode(event, target, data, origin="", sendid="", content_type=XML_CONTENT_TYPE):
+        '''
+        Outputs the message in the encoding of content_type, as a tuple of the 
+        message and its content type. Falls back to XML unless data would be 
+        read back from JSON exactly as it is (see isExactJson).
+        '''
+        if content_type == JSON_CONTENT_TYPE and isExactJson(data):
+            return SCXMLEventProcessor.tojson(event, target, data, origin, sendid), JSON_CONTENT_TYPE
+        return SCXMLEventProcessor.toxml(event, target, data, origin, sendid), XML_CONTENT_TYPE
+    
+    @staticmethod
+    def toBatch(messages):
+        '''
+        Takes a list of SCXML message xml structures, as output by toxml, and 
+        outputs a single scxml:messages element holding them, in order.
+        '''
+        return '<scxml:messages xmlns:scxml="http://www.w3.org/2005/07/scxml">%s</scxml:messages>' % "".join(messages)
+    
+    @staticmethod
+    def isBatch(xmlstr):
+        return xmlstr.lstrip().startswith("<scxml:messages")
+    
+    @staticmethod
+    def fromBatch(xmlstr, origintype="scxml"):
+        '''Takes an scxml:messages structure and outputs a list of the events in it.'''
+        xml = etree.fromstring(xmlstr)
+        return [SCXMLEventProcessor.fromElement(message, origintype) for message in xml]
+    
     @staticmethod
     def fromxml(xmlstr, origintype="scxml"):
         '''
         Takes an SCXML message xml stucture and outputs the equivalent 
         scxml.eventprocessor.Event object.
         '''
-
-        xml = etree.fromstring(xmlstr)
-
+        return SCXMLEventProcessor.fromElement(etree.fromstring(xmlstr), origintype)
+    
+    @staticmethod
+    def fromElement(xml, origintype="scxml"):
         data = {}
         for prop in xml.getiterator("{http://www.w3.org/2005/07/scxml}property"):
-            if xml.get("language") == "json":
-                import json
-                value = json.loads(prop.text)
-            elif xml.get("language") == "python":
-                value = pickle.loads(prop.text)
-            
             #data under the property content is assumed to be plain text
             if prop.get("name") == "content":
                 value = prop.text
+            elif xml.get("language") == "json":
+                value = json.loads(prop.text)
+            elif xml.get("language") == "python":
+                value = pickle.loads(prop.text)
             
             data[prop.get("name")] = value
         
@@ -86,24 +157,100 @@ class SCXMLEventProcessor(object):
         return event
     
 class Event(object):
+    '''
+    An event. The name is kept both as a dot delimited string and as 
+    a tuple of interned tokens, which is what transitions are matched against. 
+    '''
+    # queued is the time the event was put in an external queue, set only if 
+    # the queue has metrics (see scxml.metrics).
+    __slots__ = ("name", "tokens", "data", "invokeid", "type", "origin", 
+                 "origintype", "sendid", "raw", "language", "queued", "__weakref__")
+    
     def __init__(self, name, data={}, invokeid=None, eventtype="platform", sendid=None, raw=None):
             
 #        self.name = name.split(".") if hasattr(name, "split") else name
-        self.name = ".".join(name) if type(name) is list else name
+        name = ".".join(name) if type(name) in (list, tuple) else name
+        self.name = name
+        self.tokens = _tokens.get(name) or tokenize(name)
         self.data = data
         self.invokeid = invokeid
         self.type = eventtype
         self.origin = None
-        self.origintype = ScxmlOriginType()
+        self.origintype = scxmlOriginType
         self.sendid = sendid
         self.raw = raw
-        
+        self.language = None
+    
+    def toDict(self):
+        '''Returns the fields of the event, as they appear in _event.'''
+        d = {"name" : self.name, 
+             "data" : self.data, 
+             "invokeid" : self.invokeid, 
+             "type" : self.type, 
+             "origin" : self.origin, 
+             "origintype" : self.origintype, 
+             "sendid" : self.sendid, 
+             "raw" : self.raw}
+        if self.language is not None:
+            d["language"] = self.language
+        return d
         
     def __str__(self):
-        return "<eventprocessor.Event>, " + str(self.__dict__)
-    
+        return "<eventprocessor.Event>, " + str(self.toDict())
+
+
+# the number of event names whose tokens are remembered.
+TOKEN_CACHE_SIZE = 10000
+_tokens = {}
+
+def isExactJson(value):
+    '''
+    True if value is read back from JSON (see SCXMLEventProcessor.fromdict) 
+    as an equal value of the same types: None, a bool, an int, a finite float, 
+    a UTF-8 encoded str, or a list or a dict with str keys of such values.
+    '''
+    if value is None or type(value) in (bool, int):
+        return True
+    if type(value) is float:
+        return value - value == 0 # not inf or nan
+    if type(value) is str:
+        try:
+            value.decode("utf-8")
+        except UnicodeDecodeError:
+            return False
+        return True
+    if type(value) is list:
+        return all(isExactJson(x) for x in value)
+    if type(value) is dict:
+        return all(type(k) is str and isExactJson(k) and isExactJson(v) for k, v in value.iteritems())
+    return False
+
+def encodeStrings(value):
+    '''Returns value, as read by json.loads, with its unicode strings encoded as UTF-8 str.'''
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    if isinstance(value, list):
+        return [encodeStrings(x) for x in value]
+    if isinstance(value, dict):
+        return dict((encodeStrings(k), encodeStrings(v)) for k, v in value.iteritems())
+    return value
+
+def tokenize(name):
+    '''Returns the tokens of the dot delimited event name as a tuple of interned strings.'''
+    tokens = _tokens.get(name)
+    if tokens is None:
+        if len(_tokens) >= TOKEN_CACHE_SIZE:
+            _tokens.clear()
+        tokens = _tokens[name] = tuple(map(internToken, name.split(".")))
+    return tokens
+
+def internToken(token):
+    return intern(token) if type(token) is str else token
+
 
 class ScxmlOriginType(object):
+    __slots__ = ("types",)
+    
     def __init__(self):
         self.types = ("http://www.w3.org/TR/scxml/#SCXMLEventProcessor", "scxml")
     def __eq__(self, other):
@@ -113,6 +260,9 @@ class ScxmlOriginType(object):
     def __str__(self):
         return self.types[0]
 
+# shared by all events, since it's never modified.
+scxmlOriginType = ScxmlOriginType()
+
 
 class ScxmlMessage(object):
     def __init__(self, name, source='', target='', data={}, sendid='', sourcetype='scxml'):
@@ -0,0 +1,330 @@
+'''
+This file is part of PySCXML.
+
+    PySCXML is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Lesser General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    PySCXML is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU Lesser General Public License for more details.
+
+    You should have received a copy of the GNU Lesser General Public License
+    along with PySCXML. If not, see <http://www.gnu.org/licenses/>.
+
+    The external event queue of a session.
+'''
+
+from collections import deque
+from eventlet.queue import Queue, Full
+from eventlet.greenthread import getcurrent
+from eventprocessor import Event
+import time
+
+# what EventQueue.put does when the queue is full.
+POLICIES = ("block", "drop_oldest", "drop_newest", "error")
+
+# what EventQueue.get does with an event past its deadline.
+EXPIRY_POLICIES = ("drop", "error")
+
+# how EventQueue.put collapses an event into a queued event of the same name.
+COALESCE_POLICIES = ("latest", "merge", "count")
+
+
+class PriorityDeque(object):
+    '''
+    The contents of an EventQueue with priorities or deadlines: a deque of 
+    (deadline, item) pairs per priority, where the highest priority is served first.
+    '''
+    def __init__(self, classify):
+        # item -> (priority, deadline)
+        self.classify = classify
+        self.classes = {}
+        # the priorities, highest first
+        self.order = []
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        for priority in self.order:
+            for deadline, item in self.classes[priority]:
+                yield item
+
+    def append(self, item):
+        priority, deadline = self.classify(item)
+        if priority not in self.classes:
+            self.classes[priority] = deque()
+            self.order = sorted(self.classes, reverse=True)
+        self.classes[priority].append((deadline, item))
+        self.size += 1
+
+    def first(self):
+        '''Returns the deque holding the next item, or None if empty.'''
+        for priority in self.order:
+            if self.classes[priority]:
+                return self.classes[priority]
+
+    def popleft(self):
+        pairs = self.first()
+        if pairs is None:
+            raise IndexError("pop from an empty PriorityDeque")
+        self.size -= 1
+        return pairs.popleft()[1]
+
+    def dropOldest(self):
+        '''Removes and returns the oldest event of the lowest priority.'''
+        for priority in reversed(self.order):
+            pairs = self.classes[priority]
+            for i, (deadline, item) in enumerate(pairs):
+                if isinstance(item, Event):
+                    del pairs[i]
+                    self.size -= 1
+                    return item
+
+
+class EventQueue(Queue):
+    '''
+    An eventlet Queue that may be bounded. When a bounded queue is full, an event
+    is handled according to the policy:
+
+        block: the sender waits until the session has consumed an event.
+        drop_oldest: the event that has been waiting the longest is discarded 
+        (Full is raised if no event is waiting, only other objects).
+        drop_newest: the event being sent is discarded.
+        error: eventlet.queue.Full is raised to the sender, which for a <send>
+        results in an error.communication event in the sending session.
+
+    A session sending to its own full queue can't wait for itself, so the block
+    policy raises Full in that case. Objects that aren't events (such as
+    scxml.interpreter.CancelEvent) are never held back.
+    
+    Events are served in the order they were put, unless priorities is given. It
+    maps event name prefixes to numbers, and events with the highest priority are 
+    served first (events that match no prefix have priority 0). The order of events 
+    of the same priority is kept. Likewise, deadlines maps event name prefixes to 
+    the number of seconds an event may wait in the queue. An event found past its 
+    deadline is dropped, or if expired is 'error', replaced by the event 
+    error.platform.deadline, with the name and data of the stale event as data.
+    Example: 
+    
+    EventQueue(priorities={"cancel" : 10, "telemetry" : -1}, deadlines={"telemetry" : 0.5})
+    
+    Finally, coalesce maps event name prefixes to a policy for events put while 
+    an event of the same name (and invokeid) is still queued. Instead of adding 
+    the new event, the queued one is updated: 
+    
+        latest: the queued event takes the data of the new event.
+        merge: the data dict of the new event is merged into the data of the queued 
+        event (or replaces it, if either isn't a dict).
+        count: like latest, but the data gets the item 'count', the number of 
+        events the queued event stands for, starting at 1 when it's queued. 
+        Data that isn't a dict is wrapped as {"data" : data}, so that an event 
+        has the same shape whether or not others were collapsed into it.
+    
+    The queued event keeps its place in the queue (and its deadline).
+    
+    Each event that is dropped, expires or is collapsed into a queued event is 
+    passed to onDiscard, if set, along with the queued event in the last case 
+    (see scxml.interpreter.Interpreter.whenProcessed).
+    '''
+
+    def __init__(self, maxsize=None, policy="block", priorities=None, deadlines=None, expired="drop", coalesce=None):
+        if policy not in POLICIES:
+            raise ValueError("Unknown queue policy '%s', use one of %s." % (policy, ", ".join(POLICIES)))
+        if expired not in EXPIRY_POLICIES:
+            raise ValueError("Unknown expiry policy '%s', use one of %s." % (expired, ", ".join(EXPIRY_POLICIES)))
+        for name, how in (coalesce or {}).items():
+            if how not in COALESCE_POLICIES:
+                raise ValueError("Unknown coalesce policy '%s' for '%s', use one of %s." % (how, name, ", ".join(COALESCE_POLICIES)))
+        Queue.__init__(self, maxsize)
+        self.policy = policy
+        self.priorities = dict((tuple(k.split(".")), v) for k, v in (priorities or {}).items())
+        self.deadlines = dict((tuple(k.split(".")), v) for k, v in (deadlines or {}).items())
+        self.expired = expired
+        self.coalesce = dict((tuple(k.split(".")), v) for k, v in (coalesce or {}).items())
+        # event name -> the queued event later events of that name are collapsed into
+        self.pending = {}
+        # event -> the number of events it stands for
+        self.counts = {}
+        if self.priorities or self.deadlines:
+            self.queue = PriorityDeque(self.classify)
+        # the greenthread reading from the queue
+        self.consumer = None
+        self.received = 0
+        self.dropped = 0
+        self.expiredCount = 0
+        self.coalesced = 0
+        self.maxDepth = 0
+        # a scxml.metrics.Metrics the depth and wait times are reported to, if any
+        self.metrics = None
+        # called before anything is put in the queue, if set (see scxml.batch.SessionCohort)
+        self.onPut = None
+        # called with each event the queue discards and the queued event standing for it, if any
+        self.onDiscard = None
+
+    def put(self, item, block=True, timeout=None):
+        self.received += 1
+        if self.onPut is not None:
+            self.onPut()
+        if self.metrics is not None and isinstance(item, Event):
+            item.queued = time.time()
+        if self.coalesce and isinstance(item, Event) and self._coalesce(item):
+            self.coalesced += 1
+        elif not isinstance(item, Event) or not self.full():
+            self._force(item)
+        elif self.policy == "drop_newest":
+            self.dropped += 1
+            self._discard(item)
+        elif self.policy == "drop_oldest" and self._dropOldest() is not None:
+            self.dropped += 1
+            self._force(item)
+        elif self.policy == "block" and block and getcurrent() is not self.consumer:
+            Queue.put(self, item, block, timeout)
+        else:
+            raise Full("The event queue is full.")
+        self.maxDepth = max(self.maxDepth, self.qsize())
+
+    def canTake(self, n):
+        '''
+        False if putting n events could raise Full under the error policy. Events 
+        that would be coalesced are counted as well, so the answer errs on the 
+        safe side.
+        '''
+        return self.maxsize is None or self.policy != "error" or self.qsize() + n <= self.maxsize
+
+    def _coalesce(self, item):
+        '''Collapses item into a queued event of the same name. Returns False if there is none.'''
+        queued = self.pending.get(item.name)
+        if queued is None or queued.invokeid != item.invokeid:
+            return False
+        how = lookup(self.coalesce, item.name.split("."), None)
+        if how == "merge" and isinstance(queued.data, dict) and isinstance(item.data, dict):
+            data = dict(queued.data)
+            data.update(item.data)
+        else:
+            data = item.data
+        if how == "count":
+            self.counts[queued] = self.counts.get(queued, 1) + 1
+            data = countedData(data, self.counts[queued])
+        queued.data = data
+        queued.raw = item.raw
+        queued.sendid = item.sendid
+        queued.origin = item.origin
+        self._discard(item, queued)
+        return True
+
+    def _put(self, item):
+        Queue._put(self, item)
+        if self.coalesce and isinstance(item, Event):
+            how = lookup(self.coalesce, item.name.split("."), None)
+            if how:
+                self.pending[item.name] = item
+            if how == "count":
+                item.data = countedData(item.data, 1)
+
+    def _get(self):
+        item = Queue._get(self)
+        if self.pending:
+            self._forget(item)
+        return item
+
+    def _forget(self, item):
+        '''Stops coalescing events into item, which has left the queue.'''
+        if isinstance(item, Event) and self.pending.get(item.name) is item:
+            del self.pending[item.name]
+            self.counts.pop(item, None)
+
+    def _discard(self, item, replacement=None):
+        if self.onDiscard is not None:
+            self.onDiscard(item, replacement)
+
+    def _force(self, item):
+        '''Adds item even if the queue is full.'''
+        self._put(item)
+        if self.getters:
+            self._schedule_unlock()
+
+    def classify(self, item):
+        '''Returns the priority and the deadline of item.'''
+        if not isinstance(item, Event):
+            return float("inf"), None
+        tokens = item.name.split(".")
+        priority = lookup(self.priorities, tokens, 0)
+        timeout = lookup(self.deadlines, tokens, None)
+        return priority, time.time() + timeout if timeout is not None else None
+
+    def _dropOldest(self):
+        '''Removes and returns the oldest event, or None if only other objects are queued.'''
+        if isinstance(self.queue, PriorityDeque):
+            dropped = self.queue.dropOldest()
+        else:
+            dropped = None
+            for i, queued in enumerate(self.queue):
+                if isinstance(queued, Event):
+                    del self.queue[i]
+                    dropped = queued
+                    break
+        if dropped is not None:
+            self._forget(dropped)
+            self._discard(dropped)
+        return dropped
+
+    def get(self, block=True, timeout=None):
+        self.consumer = getcurrent()
+        if self.deadlines:
+            self._expire()
+        item = Queue.get(self, block, timeout)
+        if self.metrics is not None:
+            self.metrics.onGet(self, item)
+        return item
+
+    def _expire(self):
+        '''Handles the events past their deadline at the head of the queue.'''
+        now = time.time()
+        while True:
+            pairs = self.queue.first()
+            if pairs is None: return
+            deadline, item = pairs[0]
+            if deadline is None or deadline >= now: return
+            self.expiredCount += 1
+            self._forget(item)
+            self._discard(item)
+            if self.expired == "error":
+                error = Event(["error", "platform", "deadline"], {"name" : item.name, "data" : item.data})
+                pairs[0] = (None, error)
+                return
+            pairs.popleft()
+            self.queue.size -= 1
+
+    def getStats(self):
+        '''Returns the current and largest depth of the queue and the number of events put and dropped.'''
+        return {"depth" : self.qsize(),
+                "max_depth" : self.maxDepth,
+                "maxsize" : self.maxsize,
+                "received" : self.received,
+                "dropped" : self.dropped,
+                "expired" : self.expiredCount,
+                "coalesced" : self.coalesced,
+                "blocked" : self.putting()}
+
+
+def countedData(data, count):
+    '''Returns a copy of data as a dict, with the item 'count' (see EventQueue).'''
+    data = dict(data) if isinstance(data, dict) else {"data" : data}
+    data["count"] = count
+    return data
+
+def lookup(mapping, tokens, default):
+    '''Returns the value for the longest prefix of tokens in mapping.'''
+    for i in range(len(tokens), 0, -1):
+        value = mapping.get(tuple(tokens[:i]))
+        if value is not None:
+            return value
+    return default
+
+
+__all__ = ["EventQueue", "PriorityDeque", "POLICIES", "EXPIRY_POLICIES", "COALESCE_POLICIES", "Full"]
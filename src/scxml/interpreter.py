@@ -28,14 +28,17 @@ from node import *
 
 from datastructures import OrderedSet
 from eventprocessor import Event
-from louie import dispatcher
-from scxml.eventprocessor import ScxmlOriginType
+from signals import Signaller
+from scxml.eventprocessor import scxmlOriginType
 import eventlet
+import time
+import logging
 from eventlet import Queue
+from eventqueue import EventQueue
 from scxml.datamodel import ECMAScriptDataModel
 
 
-class Interpreter(object):
+class Interpreter(Signaller):
     '''
     The class repsonsible for keeping track of the execution of the 
     statemachine.
@@ -47,10 +50,40 @@ class Interpreter(object):
         self.configuration = OrderedSet()
         
         self.internalQueue = Queue()
-        self.externalQueue = Queue()
+        self.externalQueue = EventQueue()
         
         self.statesToInvoke = OrderedSet()
         self.historyValue = {}
+        # eventless transitions whose cond was false, mapped to a snapshot of its inputs
+        self.falseConditions = {}
+        # the scxml.batch.SessionCohort this interpreter's configuration is reported to, if any
+        self.cohort = None
+        # cond results of the current selection pass
+        self.condMemo = {}
+        self.condMemoHits = 0
+        self.condMemoMisses = 0
+        # if True, external events that no transition of the document can match are dropped by send
+        self.discardUnusedEvents = False
+        self.discardedEvents = 0
+        # the number of macrosteps, and the milliseconds of work (if set), between yields to the hub
+        self.quantumEvents = 1
+        self.quantumTime = None
+        self.quantumStart = None
+        self.quantumCount = 0
+        self.quantumYields = 0
+        self.quantumExhausted = 0
+        # a scxml.tracer.Tracer, if the steps of this session should be traced
+        self.tracer = None
+        # a scxml.metrics.Metrics the duration of macrosteps is reported to, if any
+        self.metrics = None
+        # a scxml.watchdog.Watchdog that macrosteps are registered with, if any
+        self.watchdog = None
+        # external event -> the eventlet.event.Events sent when its macrostep has finished (see whenProcessed)
+        self.acks = {}
+        self.macrostepStart = None
+        self.macrostepEvent = None
+        self.macrostepAcks = None
+        self.doc = None
         self.dm = None
         self.invokeId = None
         self.parentId = None
@@ -62,6 +95,10 @@ class Interpreter(object):
         
         self.doc = document
         self.invokeId = invokeId
+        if self.tracer or self.metrics or self.watchdog or self.quantumTime is not None:
+            self.startMacrostep(None)
+        # the initial transition is taken in this greenthread, which mustn't block on its own queue.
+        self.externalQueue.consumer = eventlet.getcurrent()
         
         transition = Transition(document.rootState)
         transition.target = document.rootState.initial
@@ -73,6 +110,9 @@ class Interpreter(object):
     
     
     def mainEventLoop(self):
+        if self.doc.compiled and self.doc.compiled.isFlat:
+            return self.flatEventLoop()
+        
         while self.running:
             enabledTransitions = None
             stable = False
@@ -94,7 +134,7 @@ class Interpreter(object):
                 if enabledTransitions:
                     self.microstep(enabledTransitions)
 #                eventlet.greenthread.sleep()
-            eventlet.greenthread.sleep()
+            self.endMacrostep()
                 
                     
             
@@ -106,7 +146,13 @@ class Interpreter(object):
             if not self.internalQueue.empty():
                 continue
             
+            if self.cohort:
+                self.cohort.wait(self)
             externalEvent = self.externalQueue.get() # this call blocks until an event is available
+            if self.cohort:
+                self.cohort.setBusy(self, True)
+            if self.tracer or self.metrics or self.watchdog or self.acks or self.quantumTime is not None:
+                self.startMacrostep(externalEvent)
             
 #            if externalEvent.name == "cancel.invoke.%s" % self.dm.sessionid:
 #                continue
@@ -137,7 +183,142 @@ class Interpreter(object):
          
     
         
+    def flatEventLoop(self):
+        '''
+        The mainEventLoop of flat documents (see scxml.codegen), which take at most 
+        one transition per microstep, found in the table of the compiled document. 
+        '''
+        compiled = self.doc.compiled
+        while self.running:
+            t = compiled.getFlatTransition(self.getAtomicState(), None)
+            if t:
+                self.microstep([t])
+                continue
+            
+            if not self.internalQueue.empty():
+                event = self.internalQueue.get()
+                self.logger.info("internal event found: %s", event.name)
+            else:
+                self.endMacrostep()
+                if not self.internalQueue.empty():
+                    continue
+                
+                if self.cohort:
+                    self.cohort.wait(self)
+                event = self.externalQueue.get() # this call blocks until an event is available
+                if self.cohort:
+                    self.cohort.setBusy(self, True)
+                if self.tracer or self.metrics or self.watchdog or self.acks or self.quantumTime is not None:
+                    self.startMacrostep(event)
+                if isCancelEvent(event):
+                    self.running = False
+                    continue
+                self.logger.info("external event found: %s", event.name)
+            
+            self.dm["__event"] = event
+            t = compiled.getFlatTransition(self.getAtomicState(), event.name)
+            if t:
+                self.microstep([t])
+        
+        self.exitInterpreter()
+    
+    def endMacrostep(self):
+        '''
+        Yields to the hub once the current quantum is used up, i.e after quantumEvents 
+        macrosteps or quantumTime milliseconds, whichever comes first. A session 
+        waiting on an empty external queue yields anyway, which starts a new quantum.
+        '''
+        now = time.time()
+        if self.macrostepStart is not None:
+            self.finishMacrostep()
+        if self.quantumStart is None:
+            self.quantumStart = now
+        self.quantumCount += 1
+        exhausted = (self.quantumEvents is not None and self.quantumCount >= self.quantumEvents) or \
+            (self.quantumTime is not None and (now - self.quantumStart) * 1000 >= self.quantumTime)
+        if exhausted or self.externalQueue.empty():
+            if exhausted and not self.externalQueue.empty():
+                self.quantumExhausted += 1
+            self.quantumYields += 1
+            self.quantumCount = 0
+            self.quantumStart = None
+            eventlet.greenthread.sleep()
+    
+    def startMacrostep(self, event):
+        self.macrostepStart = time.time()
+        if self.quantumStart is None:
+            # the quantum includes the work of its first macrostep
+            self.quantumStart = self.macrostepStart
+        self.macrostepEvent = {"event" : event.name} if isinstance(event, Event) else None
+        if self.watchdog:
+            self.watchdog.enter("macrostep", self.dm.sessionid, None)
+        if self.acks:
+            self.macrostepAcks = self.acks.pop(event, None)
+    
+    def finishMacrostep(self):
+        if self.tracer:
+            self.tracer.span("macrostep", self.dm.sessionid, self.macrostepStart, self.macrostepEvent)
+        if self.metrics:
+            self.metrics.onMacrostep(time.time() - self.macrostepStart)
+        if self.watchdog:
+            self.watchdog.leave()
+        if self.macrostepAcks:
+            for ack in self.macrostepAcks:
+                ack.send(True)
+        self.macrostepStart = self.macrostepEvent = self.macrostepAcks = None
+    
+    def whenProcessed(self, event):
+        '''
+        Returns an eventlet.event.Event that is sent True once the macrostep started 
+        by the external event has finished, or False if the session exits before 
+        taking the event from its queue. Call before putting the event in the queue. 
+        If the queue drops the event, or it expires, None is sent instead. If the 
+        queue collapses it into a queued event (see EventQueue), it's acknowledged 
+        along with that event.
+        '''
+        ack = eventlet.event.Event()
+        self.acks.setdefault(event, []).append(ack)
+        self.externalQueue.onDiscard = self.onDiscard
+        return ack
+    
+    def cancelAck(self, ack):
+        '''Forgets ack, as returned by whenProcessed, which is then never sent.'''
+        for event, acks in self.acks.items():
+            if ack in acks:
+                acks.remove(ack)
+                if not acks:
+                    del self.acks[event]
+                return
+    
+    def onDiscard(self, event, replacement):
+        '''Called by the external queue for an event it has dropped or collapsed into replacement.'''
+        acks = self.acks.pop(event, None)
+        if not acks: return
+        if replacement is None:
+            for ack in acks:
+                ack.send(None)
+        else:
+            self.acks.setdefault(replacement, []).extend(acks)
+    
+    def getQuantumStats(self):
+        '''Returns the number of yields to the hub, and how many of those left events in the external queue.'''
+        return {"yields" : self.quantumYields, 
+                "exhausted" : self.quantumExhausted,
+                "queued" : self.externalQueue.qsize()}
+    
+    def getAtomicState(self):
+        '''Returns the atomic state of the configuration of a flat document.'''
+        for s in reversed(self.configuration):
+            if isAtomicState(s):
+                return s
+        
     def exitInterpreter(self):
+        if self.macrostepStart is not None:
+            self.finishMacrostep()
+        for acks in self.acks.values():
+            for ack in acks:
+                ack.send(False)
+        self.acks.clear()
         statesToExit = sorted(self.configuration, key=exitOrder)
         for s in statesToExit:
             for content in s.onexit:
@@ -149,23 +330,28 @@ class Interpreter(object):
                 if self.invokeId and self.parentId and self.parentId in self.dm.sessions:
                     self.send(["done", "invoke", self.invokeId], s.donedata(), self.invokeId, self.dm.sessions[self.parentId].interpreter.externalQueue)   
                 self.logger.info("Exiting interpreter")
-                dispatcher.send("signal_exit", self, final=s.id)
+                self.emit("signal_exit", final=s.id)
                 self.exited = True
                 return
         self.exited = True
-        dispatcher.send("signal_exit", self, final=None)
+        self.emit("signal_exit", final=None)
             
         
     def selectEventlessTransitions(self):
-        enabledTransitions = OrderedSet()
+        self.condMemo.clear()
         atomicStates = filter(isAtomicState, self.configuration)
         atomicStates = sorted(atomicStates, key=documentOrder)
+        if self.doc.compiled:
+            enabledTransitions = self.doc.compiled.selectEventlessTransitions(atomicStates, self.eventlessConditionMatch)
+            return self.filterPreempted(enabledTransitions)
+        
+        enabledTransitions = OrderedSet()
         for state in atomicStates:
             done = False
             for s in [state] + getProperAncestors(state, None):
                 if done: break
                 for t in s.transition:
-                    if not t.event and self.conditionMatch(t): 
+                    if not t.event and self.eventlessConditionMatch(t): 
                         enabledTransitions.add(t)
                         done = True
                         break
@@ -174,16 +360,20 @@ class Interpreter(object):
     
     
     def selectTransitions(self, event):
-        enabledTransitions = OrderedSet()
+        self.condMemo.clear()
         atomicStates = filter(isAtomicState, self.configuration)
         atomicStates = sorted(atomicStates, key=documentOrder)
-
+        if self.doc.compiled:
+            enabledTransitions = self.doc.compiled.selectTransitions(atomicStates, event.tokens, self.conditionMatch)
+            return self.filterPreempted(enabledTransitions)
+        
+        enabledTransitions = OrderedSet()
         for state in atomicStates:
             done = False
             for s in [state] + getProperAncestors(state, None):
                 if done: break
                 for t in s.transition:
-                    if t.event and nameMatch(t.event, event.name.split(".")) and self.conditionMatch(t):
+                    if t.event and nameMatch(t.event, event.tokens) and self.conditionMatch(t):
                         enabledTransitions.add(t)
                         done = True
                         break
@@ -234,25 +424,54 @@ class Interpreter(object):
     
     
     def microstep(self, enabledTransitions):
+        if self.tracer:
+            return self.tracedMicrostep(enabledTransitions)
         self.exitStates(enabledTransitions)
         self.executeTransitionContent(enabledTransitions)
         self.enterStates(enabledTransitions)
-        self.logger.info("new config: {" + ", ".join([s.id for s in self.configuration if s.id != "__main__"]) + "}")
-    
+        self.logConfiguration()
+    
+    def tracedMicrostep(self, enabledTransitions):
+        '''microstep, recording a span for it and each of its phases in self.tracer.'''
+        sessionid = self.dm.sessionid
+        start = time.time()
+        for phase in (self.exitStates, self.executeTransitionContent, self.enterStates):
+            phaseStart = time.time()
+            phase(enabledTransitions)
+            self.tracer.span(phase.__name__, sessionid, phaseStart)
+        self.logConfiguration()
+        self.tracer.span("microstep", sessionid, start)
+    
+    def logConfiguration(self):
+        if self.logger.isEnabledFor(logging.INFO):
+            self.logger.info("new config: {" + ", ".join([s.id for s in self.configuration if s.id != "__main__"]) + "}")
+    
+    
+    def getTransitionDomain(self, t):
+        '''Returns the state whose descendants are exited and entered by the transition t.'''
+        tstates = self.getTargetStates(t.target)
+        if t.type == "internal" and isCompoundState(t.source) and all(map(lambda s: isDescendant(s,t.source), tstates)):
+            return t.source
+        else:
+            return self.findLCA([t.source] + tstates)
     
-    def exitStates(self, enabledTransitions):
+    def getStatesToExit(self, enabledTransitions):
+        if self.doc.compiled:
+            planned = self.doc.compiled.getStatesToExit(enabledTransitions, self.configuration)
+            if planned is not None:
+                return planned
         statesToExit = OrderedSet()
         for t in enabledTransitions:
             if t.target:
-                tstates = self.getTargetStates(t.target)
-                if t.type == "internal" and isCompoundState(t.source) and all(map(lambda s: isDescendant(s,t.source), tstates)):
-                    ancestor = t.source
-                else:
-                    ancestor = self.findLCA([t.source] + tstates)
+                ancestor = self.getTransitionDomain(t)
                 
                 for s in self.configuration:
                     if isDescendant(s,ancestor):
                         statesToExit.add(s)
+        return statesToExit
+    
+    def exitStates(self, enabledTransitions):
+        statesToExit = self.getStatesToExit(enabledTransitions)
         
         for s in statesToExit:
             self.statesToInvoke.delete(s)
@@ -282,16 +501,18 @@ class Interpreter(object):
             self.executeContent(t)
     
     
-    def enterStates(self, enabledTransitions):
+    def getStatesToEnter(self, enabledTransitions):
+        '''Returns the states to enter, in entry order, and the subset of them entered by default.'''
+        if self.doc.compiled and len(enabledTransitions) == 1:
+            planned = self.doc.compiled.getStatesToEnter(enabledTransitions[0])
+            if planned is not None:
+                return planned
         statesToEnter = OrderedSet()
         statesForDefaultEntry = OrderedSet()
         for t in enabledTransitions:
             if t.target:
                 tstates = self.getTargetStates(t.target)
-                if t.type == "internal" and isCompoundState(t.source) and all(map(lambda s: isDescendant(s,t.source), tstates)):
-                    ancestor = t.source
-                else:
-                    ancestor = self.findLCA([t.source] + tstates)
+                ancestor = self.getTransitionDomain(t)
                 for s in tstates:
                     self.addStatesToEnter(s,statesToEnter,statesForDefaultEntry)
                 for s in tstates:
@@ -303,6 +524,10 @@ class Interpreter(object):
                                     self.addStatesToEnter(child, statesToEnter,statesForDefaultEntry)
 
         statesToEnter.sort(key=enterOrder)
+        return statesToEnter, statesForDefaultEntry
+    
+    def enterStates(self, enabledTransitions):
+        statesToEnter, statesForDefaultEntry = self.getStatesToEnter(enabledTransitions)
         for s in statesToEnter:
             self.statesToInvoke.add(s)
             self.configuration.add(s)
@@ -324,6 +549,8 @@ class Interpreter(object):
         for s in self.configuration:
             if isFinalState(s) and isScxmlState(s.parent):
                 self.running = False;
+        if self.cohort:
+            self.cohort.update(self)
     
     
     def addStatesToEnter(self, state,statesToEnter,statesForDefaultEntry):
@@ -382,8 +609,50 @@ class Interpreter(object):
     def conditionMatch(self, t):
         if not t.cond:
             return True
-        else:
+        version = getattr(self.dm, "version", None)
+        if not t.condPure or version is None:
             return t.cond()
+        # identical conds without side effects are only evaluated once per 
+        # selection pass, unless the datamodel is written to in between.
+        key = (t.condExpr, version)
+        if key in self.condMemo:
+            self.condMemoHits += 1
+            return self.condMemo[key]
+        self.condMemoMisses += 1
+        result = t.cond()
+        # a cond that failed to evaluate returns None and should raise its error again.
+        if t.condExpr is not None and result is not None:
+            self.condMemo[key] = result
+        return result
+    
+    def getConditionStats(self):
+        '''Returns the number of cond evaluations avoided and performed by the memo table.'''
+        total = self.condMemoHits + self.condMemoMisses
+        return {"hits" : self.condMemoHits, 
+                "misses" : self.condMemoMisses, 
+                "hit_rate" : float(self.condMemoHits) / total if total else 0.0}
+    
+    def eventlessConditionMatch(self, t):
+        '''
+        Like conditionMatch, but skips the evaluation of a cond that was false 
+        the last time it was evaluated, if none of the values it reads have 
+        been rebound since then.
+        '''
+        if not t.cond or t.condDeps is None:
+            return self.conditionMatch(t)
+        snapshot = self.dm.getSnapshot(t.condDeps)
+        previous = self.falseConditions.get(t)
+        if snapshot is not None and previous is not None and \
+                all(a is b for a, b in zip(snapshot, previous)):
+            return False
+        
+        result = self.conditionMatch(t)
+        # a cond that failed to evaluate returns None and should raise its error again.
+        if snapshot is not None and not result and result is not None:
+            self.falseConditions[t] = snapshot
+        else:
+            self.falseConditions.pop(t, None)
+        return result
                 
     def In(self, name):
         return name in map(lambda x: x.id, self.configuration)
@@ -399,14 +668,28 @@ class Interpreter(object):
         """
         if isinstance(name, basestring): name = name.split(".")
         if not toQueue: toQueue = self.externalQueue
+        if toQueue is self.externalQueue and not invokeid and self.isUnusedEvent(name):
+            self.discardedEvents += 1
+            self.logger.debug("discarded event: %s", ".".join(name))
+            return
         evt = Event(name, data, invokeid, sendid=sendid, eventtype=eventtype)
         evt.origin = "#_scxml_" + self.dm.sessionid
-        evt.origintype = ScxmlOriginType() if not isinstance(self.dm, ECMAScriptDataModel) else "http://www.w3.org/TR/scxml/#SCXMLEventProcessor"
+        evt.origintype = scxmlOriginType if not isinstance(self.dm, ECMAScriptDataModel) else "http://www.w3.org/TR/scxml/#SCXMLEventProcessor"
         evt.raw = raw
         #TODO: and for ecmascript?
         evt.language =  language
         toQueue.put(evt)
         
+    
+    def isUnusedEvent(self, tokens):
+        '''
+        True if the external event named by the list tokens can't enable any transition 
+        of the document. Events from invoked processes are never considered unused, 
+        since they might trigger a finalize, and neither are any events if the document 
+        has an autoforwarding invoke or an eventless transition whose cond might read _event 
+        (see SCXMLDocument.eventDescriptors).
+        '''
+        return self.discardUnusedEvents and self.doc is not None and not self.doc.canConsume(tokens)
             
     def raiseFunction(self, event, data, sendid=None, type="internal"):
         e = Event(event, data, eventtype=type, sendid=sendid)
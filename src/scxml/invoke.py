@@ -18,7 +18,7 @@ This file is part of pyscxml.
     @author Johan Roxendal
     @contact: johan@roxendal.com
 '''
-from louie import dispatcher
+from signals import Signaller
 from messaging import exec_async
 from functools import partial
 from scxml.messaging import UrlGetter
@@ -48,7 +48,7 @@ class InvokeWrapper(object):
         if self.invoke_obj:
             self.invoke_obj.finalize()
     
-class BaseInvoke(object):
+class BaseInvoke(Signaller):
     def __init__(self):
         self.invokeid = None
         self.parentSessionid = None
@@ -70,17 +70,17 @@ class BaseFetchingInvoke(BaseInvoke):
         BaseInvoke.__init__(self)
         self.getter = UrlGetter()
         
-        dispatcher.connect(self.onHttpResult, UrlGetter.HTTP_RESULT, self.getter)
-        dispatcher.connect(self.onFetchError, UrlGetter.HTTP_ERROR, self.getter)
-        dispatcher.connect(self.onFetchError, UrlGetter.URL_ERROR, self.getter)
+        self.getter.connect(UrlGetter.HTTP_RESULT, self.onHttpResult)
+        self.getter.connect(UrlGetter.HTTP_ERROR, self.onFetchError)
+        self.getter.connect(UrlGetter.URL_ERROR, self.onFetchError)
         
-    def onFetchError(self, signal, exception, **named ):
+    def onFetchError(self, sender, exception, **named ):
         self.logger.error(str(exception))
-        dispatcher.send("error.communication.invoke." + self.invokeid, self, data=exception)
+        self.emit("error.communication.invoke." + self.invokeid, data=exception)
 
-    def onHttpResult(self, signal, result, **named):
+    def onHttpResult(self, sender, result, **named):
         self.logger.debug("onHttpResult " + str(named))
-        dispatcher.send("result.invoke.%s" % (self.invokeid), self, data=result)
+        self.emit("result.invoke.%s" % (self.invokeid), data=result)
     
 
 class InvokeSCXML(BaseFetchingInvoke):
@@ -92,6 +92,8 @@ class InvokeSCXML(BaseFetchingInvoke):
         self.initData = data
         self.cancelled = False
         self.default_datamodel = "python"
+        # the LogSink of the parent session, which the child session logs to as well.
+        self.log_sink = None
     
     def start(self, parentId):
         self.parentId = parentId
@@ -107,13 +109,14 @@ class InvokeSCXML(BaseFetchingInvoke):
         self.sm = StateMachine(doc, 
                                sessionid=self.parentSessionid + "." + self.invokeid, 
                                default_datamodel=self.default_datamodel,
-                               log_function=lambda label, val: dispatcher.send(signal="invoke_log", sender=self, label=label, msg=val),
+                               log_function=lambda label, val: self.emit("invoke_log", label=label, msg=val),
+                               log_sink=self.log_sink,
                                setup_session=False)
         self.interpreter = self.sm.interpreter
         self.sm.compiler.initData = self.initData
         self.sm.compiler.parentId = self.parentId
         self.sm.interpreter.parentId = self.parentId
-        dispatcher.send("created", sender=self, sm=self.sm)
+        self.emit("created", sm=self.sm)
         self.sm._start_invoke(self.invokeid)
         eventlet.spawn(self.sm.interpreter.mainEventLoop)
 
@@ -122,7 +125,7 @@ class InvokeSCXML(BaseFetchingInvoke):
         if self.sm and not self.sm.isFinished():
             self.sm.interpreter.externalQueue.put(eventobj)
     
-    def onHttpResult(self, signal, result, **named):
+    def onHttpResult(self, sender, result, **named):
         self.logger.debug("onHttpResult " + str(named))
         self._start(result)
         
@@ -145,11 +148,11 @@ class InvokeHTTP(BaseFetchingInvoke):
         self.getter.get_async(self.content, eventobj.data, type=eventobj.name.join("."))
     
     def start(self, parentQueue):
-        dispatcher.send("init.invoke." + self.invokeid, self)
+        self.emit("init.invoke." + self.invokeid)
         
-    def onHttpResult(self, signal, result, **named):
+    def onHttpResult(self, sender, result, **named):
         self.logger.debug("onHttpResult " + str(named))
-        dispatcher.send("result.invoke.%s" % (self.invokeid), self, data={"response" : result})
+        self.emit("result.invoke.%s" % (self.invokeid), data={"response" : result})
 
 class InvokeSOAP(BaseInvoke):
     
@@ -163,13 +166,13 @@ class InvokeSOAP(BaseInvoke):
     def init(self):
         from suds.client import Client #@UnresolvedImport
         self.client = Client(self.content)
-        dispatcher.send("init.invoke." + self.invokeid, self)
+        self.emit("init.invoke." + self.invokeid)
         
     def send(self, eventobj):
         exec_async(partial(self.soap_send_sync, ".".join(eventobj.name), eventobj.data))
         
     def soap_send_sync(self, method, data):
         result = getattr(self.client.service, method)(**data)
-        dispatcher.send("result.invoke.%s.%s" % (self.invokeid, method), self, data=result)
+        self.emit("result.invoke.%s.%s" % (self.invokeid, method), data=result)
 
 __all__ = ["InvokeWrapper", "InvokeSCXML", "InvokeSOAP", "InvokeHTTP"]
\ No newline at end of file
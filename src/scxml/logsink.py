@@ -0,0 +1,150 @@
+'''
+This file is part of PySCXML.
+
+    PySCXML is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Lesser General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    PySCXML is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU Lesser General Public License for more details.
+
+    You should have received a copy of the GNU Lesser General Public License
+    along with PySCXML. If not, see <http://www.gnu.org/licenses/>.
+
+    Sinks for the output of <log> elements. A sink buffers the records handed
+    to it by the sessions and writes them from a separate greenthread, so that
+    executable content never waits for I/O.
+'''
+
+from collections import deque, namedtuple
+from lxml import etree
+from eventlet import tpool
+import copy
+import eventlet
+import time
+
+# the fields of a <log> record. state is the id of the state the <log> element is a descendant of.
+LogRecord = namedtuple("LogRecord", "time sessionid state label value")
+
+
+class LogSink(object):
+    '''
+    Buffers log records, at most maxsize at a time, holding copies of the 
+    logged values (see snapshot). Records arriving to a full
+    buffer are dropped and counted. This class is abstract: subclasses such as 
+    MemorySink and FileSink implement write(records), which is called with a 
+    list of LogRecords from the writer greenthread.
+    '''
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.buffer = deque()
+        self.writer = None
+        self.received = 0
+        self.written = 0
+        self.dropped = 0
+
+    def put(self, sessionid, state, label, value):
+        self.received += 1
+        if len(self.buffer) >= self.maxsize:
+            self.dropped += 1
+            return
+        self.buffer.append(LogRecord(time.time(), sessionid, state, label, snapshot(value)))
+        if self.writer is None:
+            self.writer = eventlet.spawn(self.drain)
+
+    def drain(self):
+        try:
+            while self.buffer:
+                self.flush()
+                eventlet.greenthread.sleep()
+        finally:
+            self.writer = None
+
+    def flush(self):
+        '''Writes the buffered records.'''
+        records = list(self.buffer)
+        self.buffer.clear()
+        if records:
+            self.write(records)
+            self.written += len(records)
+
+    def write(self, records):
+        raise NotImplementedError("%s does not implement write(records)." % type(self).__name__)
+
+    def getStats(self):
+        return {"buffered" : len(self.buffer),
+                "received" : self.received,
+                "written" : self.written,
+                "dropped" : self.dropped}
+
+
+class MemorySink(LogSink):
+    '''Keeps the last capacity records in self.records.'''
+    def __init__(self, maxsize=10000, capacity=10000):
+        LogSink.__init__(self, maxsize)
+        self.records = deque(maxlen=capacity)
+
+    def write(self, records):
+        self.records.extend(records)
+
+
+class FileSink(LogSink):
+    '''
+    Writes the records as lines of text to a file, given either as a path or as
+    a file-like object such as sys.stdout. The writing is done in a thread
+    from eventlet's thread pool.
+    '''
+    def __init__(self, f, maxsize=10000):
+        LogSink.__init__(self, maxsize)
+        self.file = open(f, "a") if isinstance(f, basestring) else f
+
+    def write(self, records):
+        text = "".join(map(formatRecord, records))
+        tpool.execute(self.writeText, text)
+
+    def writeText(self, text):
+        self.file.write(text)
+        self.file.flush()
+
+
+def snapshot(value):
+    '''
+    Returns a copy of value as it is now, since a record is written after the 
+    session has moved on, or the text of value if it can't be copied.
+    '''
+    if value is None or isinstance(value, (basestring, int, long, float)):
+        return value
+    try:
+        return copy.deepcopy(value)
+    except Exception:
+        return str(formatValue(value))
+
+def formatRecord(record):
+    return "%s %s [%s] %s%s%s\n" % (time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(record.time)),
+                                   record.sessionid, record.state, record.label or "",
+                                   ": " if record.label and record.value is not None else "",
+                                   formatValue(record.value))
+
+def formatValue(msg):
+    '''Returns the value of a <log> element as a string.'''
+    def f(x):
+        if etree.iselement(x):
+            return etree.tostring(x).strip()
+        elif isinstance(x, etree._ElementStringResult):
+            return str(x)
+
+        return x
+
+    if isinstance(msg, list):
+        msg = map(f, msg)
+        try:
+            msg = "\n".join(msg)
+        except:
+            msg = str(msg)
+    return msg
+
+
+__all__ = ["LogRecord", "LogSink", "MemorySink", "FileSink", "formatValue"]
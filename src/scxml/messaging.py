@@ -4,26 +4,311 @@ Created on Nov 4, 2010
 @author: johan
 '''
 
-from louie import dispatcher
+from signals import Signaller
+from eventprocessor import SCXMLEventProcessor as Processor, XML_CONTENT_TYPE, JSON_CONTENT_TYPE
 import os
-from eventlet.green import urllib2
+import errno
+from eventlet.green import urllib2, httplib, socket
+from eventlet.queue import Queue, Full
 
 from urllib import urlencode
+import urllib
 from functools import partial
 import eventlet
+import logging
+import urlparse
 
 def exec_async(io_function):
     eventlet.spawn_n(io_function)
     
 
-class UrlGetter(urllib2.HTTPDefaultErrorHandler):
+# the number of requests made by UrlGetters, and how many of them failed.
+sendStats = {"requests" : 0, "errors" : 0}
+
+
+class HttpSender(object):
+    '''
+    Makes HTTP requests from at most size greenthreads, which keep the connections
+    to each host open between requests. Requests wait in a queue for a free
+    greenthread; at most maxqueue of them, after which send raises eventlet.queue.Full.
+    A request that failed before it could be written, e.g because the connection 
+    was refused, or that was answered with 503, is made again at most retries times, 
+    after backoff, 2 * backoff, 4 * backoff... seconds. Other failures aren't retried, 
+    since the request may already have been acted on, except that a request made 
+    over an idle connection that the server had closed, which fails before any 
+    answer arrives, is made again at once on a new connection.
+    
+    UrlGetter makes its http and https requests through the HttpSender at 
+    scxml.messaging.httpSender, which may be replaced to change the settings. 
+    '''
+    RETRY_STATUS = (503,)
+    
+    def __init__(self, size=20, maxqueue=10000, retries=2, backoff=0.1, timeout=30, maxidle=4):
+        self.size = size
+        self.maxqueue = maxqueue
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        # the number of idle connections kept per host
+        self.maxidle = maxidle
+        self.queue = Queue()
+        self.workers = 0
+        self.active = 0
+        # (scheme, host, port) -> idle connections
+        self.idle = {}
+        self.logger = logging.getLogger("pyscxml.messaging")
+        self.maxDepth = 0
+        self.requests = 0
+        self.errors = 0
+        self.retried = 0
+        self.rejected = 0
+        self.connections = 0
+    
+    def send(self, url, data=None, headers=None, method=None, callback=None):
+        '''
+        Queues a request to url, a POST of data if it isn't None, otherwise a GET. 
+        callback(code, body, exception) is called when the request is done, 
+        with exception set if no response could be had. 
+        '''
+        if self.maxqueue is not None and self.queue.qsize() >= self.maxqueue:
+            self.rejected += 1
+            raise Full("The queue of outgoing HTTP requests is full.")
+        self.queue.put((url, data, headers or {}, method, callback))
+        self.maxDepth = max(self.maxDepth, self.queue.qsize())
+        if self.workers < self.size and self.queue.qsize() > self.workers - self.active:
+            self.workers += 1
+            eventlet.spawn_n(self.work)
+    
+    def work(self):
+        try:
+            while True:
+                url, data, headers, method, callback = self.queue.get()
+                self.active += 1
+                try:
+                    code, body, exception = self.request(url, data, headers, method)
+                except Exception, e:
+                    # e.g a malformed url
+                    self.errors += 1
+                    sendStats["errors"] += 1
+                    code, body, exception = None, None, e
+                finally:
+                    self.active -= 1
+                if callback:
+                    try:
+                        callback(code, body, exception)
+                    except Exception:
+                        self.logger.exception("The callback of a request to %s failed." % url)
+        finally:
+            self.workers -= 1
+    
+    def request(self, url, data, headers, method=None):
+        '''Makes the request and returns (code, body, exception).'''
+        parts = urlparse.urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = (parts.path or "/") + ("?" + parts.query if parts.query else "")
+        method = method or ("POST" if data is not None else "GET")
+        self.requests += 1
+        sendStats["requests"] += 1
+        attempt = 0
+        while True:
+            conn = self.getConnection(key)
+            # an idle connection may have been closed by the server in the meantime
+            reused = conn.sock is not None
+            written = False
+            try:
+                conn.request(method, path, data, headers)
+                written = True
+                response = conn.getresponse()
+                body = response.read()
+            except (socket.error, httplib.HTTPException), e:
+                conn.close()
+                self.connections -= 1
+                if reused and isClosedConnection(e):
+                    # the request never reached the server, so it's made again 
+                    # on a fresh connection, and the other idle ones are let go.
+                    self.closeIdle(key)
+                    self.retried += 1
+                    continue
+                if not written and attempt < self.retries:
+                    attempt = self.retry(attempt)
+                    continue
+                self.errors += 1
+                sendStats["errors"] += 1
+                return None, None, e
+            if response.will_close:
+                conn.close()
+                self.connections -= 1
+            else:
+                self.release(key, conn)
+            if response.status in self.RETRY_STATUS and attempt < self.retries:
+                attempt = self.retry(attempt)
+                continue
+            if not 200 <= response.status < 300:
+                self.errors += 1
+                sendStats["errors"] += 1
+            return response.status, body, None
+    
+    def retry(self, attempt):
+        self.retried += 1
+        eventlet.greenthread.sleep(self.backoff * 2 ** attempt)
+        return attempt + 1
+    
+    def getConnection(self, key):
+        idle = self.idle.get(key)
+        if idle:
+            return idle.pop()
+        scheme, host, port = key
+        connectionType = httplib.HTTPSConnection if scheme == "https" else httplib.HTTPConnection
+        self.connections += 1
+        return connectionType(host, port, timeout=self.timeout)
+    
+    def closeIdle(self, key):
+        for conn in self.idle.pop(key, []):
+            conn.close()
+            self.connections -= 1
+    
+    def release(self, key, conn):
+        idle = self.idle.setdefault(key, [])
+        if len(idle) < self.maxidle:
+            idle.append(conn)
+        else:
+            conn.close()
+            self.connections -= 1
+    
+    def getStats(self):
+        return {"depth" : self.queue.qsize(),
+                "max_depth" : self.maxDepth,
+                "workers" : self.workers,
+                "active" : self.active,
+                "connections" : self.connections,
+                "requests" : self.requests,
+                "errors" : self.errors,
+                "retried" : self.retried,
+                "rejected" : self.rejected}
+
+httpSender = HttpSender()
+
+def isClosedConnection(e):
+    '''True if e means that the server had closed the connection before answering.'''
+    if isinstance(e, httplib.BadStatusLine):
+        return True
+    return isinstance(e, socket.error) and e.errno in (errno.ECONNRESET, errno.EPIPE)
+
+
+class SendBatcher(object):
+    '''
+    Groups the SCXML messages sent to the same URL, in the same encoding, into a 
+    single request (see SCXMLEventProcessor.toBatch, JSON messages are sent a line 
+    each), made window seconds after the first message of the batch was sent, or 
+    as soon as the batch holds maxsize messages. The messages are kept in the order 
+    they were sent. The result of the request is reported to the UrlGetter of each 
+    message of the batch. If the request is redirected, the messages are sent again 
+    one at a time, in order, by UrlGetter.get_sync, which follows the redirect. 
+    Messages to urls that go through a proxy aren't batched (see UrlGetter.get_async).
+    
+    Batching is off unless scxml.messaging.sendBatcher is set to a SendBatcher.
+    '''
+    def __init__(self, window=0.01, maxsize=100):
+        self.window = window
+        self.maxsize = maxsize
+        # (url, content type) -> the messages, and the UrlGetters they were sent by
+        self.batches = {}
+        self.timers = {}
+        self.batchCount = 0
+        self.messageCount = 0
+    
+    def send(self, url, message, getter, content_type=XML_CONTENT_TYPE):
+        key = (url, content_type)
+        batch = self.batches.get(key)
+        if batch is None:
+            batch = self.batches[key] = []
+            self.timers[key] = eventlet.spawn_after(self.window, self.flush, key)
+        batch.append((message, getter))
+        if len(batch) >= self.maxsize:
+            self.timers[key].cancel()
+            self.flush(key)
+    
+    def flush(self, key):
+        batch = self.batches.pop(key, None)
+        del self.timers[key]
+        if not batch: return
+        url, content_type = key
+        self.batchCount += 1
+        self.messageCount += len(batch)
+        messages = [message for message, getter in batch]
+        if content_type == JSON_CONTENT_TYPE:
+            body = "\n".join(messages)
+        else:
+            body = Processor.toBatch(messages)
+        getters = []
+        for message, getter in batch:
+            if getter not in getters:
+                getters.append(getter)
+        def unbatch():
+            for message, getter in batch:
+                getter.get_sync(url, message, content_type=content_type)
+        def done(code, body, exception):
+            if code in REDIRECT_STATUS:
+                exec_async(unbatch)
+                return
+            for getter in getters:
+                getter.onResponse(url, code, body, exception)
+        try:
+            httpSender.send(url, body, {"Content-Type" : content_type}, callback=done)
+        except Full, e:
+            done(None, None, e)
+
+# set to a SendBatcher to batch the SCXML messages sent to remote processors.
+sendBatcher = None
+# the encoding of the SCXML messages sent to remote processors, XML_CONTENT_TYPE 
+# or JSON_CONTENT_TYPE. The receiver must understand it, as PySCXMLServer does.
+scxmlContentType = XML_CONTENT_TYPE
+
+
+# the answers urllib2 follows to another url
+REDIRECT_STATUS = (301, 302, 303, 307)
+
+def usesProxy(url):
+    '''True if a request to url should go through a proxy set in the environment.'''
+    parts = urlparse.urlsplit(url)
+    return parts.scheme in urllib.getproxies() and not urllib.proxy_bypass(parts.hostname or "")
+
+
+class UrlGetter(urllib2.HTTPDefaultErrorHandler, Signaller):
     HTTP_RESULT = "HTTP_RESULT"
     HTTP_ERROR = "HTTP_ERROR"
     URL_ERROR = "URL_ERROR"
     
     
     def get_async(self, url, data, type=None, content_type="application/x-www-form-urlencoded"):
-        exec_async(partial(self.get_sync, url, data, type=type, content_type=content_type))
+        '''
+        Makes the request in the background. http and https POSTs and GETs go 
+        through scxml.messaging.httpSender, unless they should go through a proxy 
+        (as set by the http_proxy, https_proxy and no_proxy environment variables), 
+        and are made by get_sync if the answer is a redirect, since only urllib2 
+        handles those. Other requests are made by get_sync in a greenthread. 
+        '''
+        if url.startswith(("http://", "https://")) and (not type or type.upper() in ("POST", "GET")) \
+                and not usesProxy(url):
+            try:
+                data = urlencode(data)
+            except: # data is probably a string to be send directly. 
+                pass
+            redirect = partial(self.get_sync, url, data, type=type, content_type=content_type)
+            httpSender.send(url, data, {"Content-Type" : content_type}, callback=partial(self.onResponse, url, redirect=redirect))
+        else:
+            exec_async(partial(self.get_sync, url, data, type=type, content_type=content_type))
+    
+    def onResponse(self, url, code, body, exception, redirect=None):
+        if redirect and code in REDIRECT_STATUS:
+            exec_async(redirect)
+        elif exception is not None:
+            self.emit(UrlGetter.URL_ERROR, exception=exception, url=url)
+        elif str(code)[0] == "2":
+            self.emit(UrlGetter.HTTP_RESULT, result=body, source=url, code=code)
+        else:
+            e = urllib2.HTTPError(url, code, "A code %s HTTP error has occurred when trying to send to target %s" % (code, url), {}, None)
+            self.emit(UrlGetter.HTTP_ERROR, exception=e)
     
     def get_sync(self, url, data, type=None, content_type="application/x-www-form-urlencoded"):
         try:
@@ -39,16 +324,19 @@ class UrlGetter(urllib2.HTTPDefaultErrorHandler):
         
         opener = urllib2.build_opener(self)
         eventlet.greenthread.sleep()
+        sendStats["requests"] += 1
         try:
             f = opener.open(req, data=data)
             if f.code is None or str(f.code)[0] == "2":
-                dispatcher.send(UrlGetter.HTTP_RESULT, self, result=f.read(), source=url, code=f.code)
+                self.emit(UrlGetter.HTTP_RESULT, result=f.read(), source=url, code=f.code)
             else:
+                sendStats["errors"] += 1
                 e = urllib2.HTTPError(url, f.code, "A code %s HTTP error has occurred when trying to send to target %s" % (f.code, url), req.headers, f)
-                dispatcher.send(UrlGetter.HTTP_ERROR, self, exception=e)
+                self.emit(UrlGetter.HTTP_ERROR, exception=e)
 #        TODO: make sure we're supposed to listen to URLErrors
         except (urllib2.URLError, ValueError), e:
-            dispatcher.send(UrlGetter.URL_ERROR, self, exception=e, url=url)
+            sendStats["errors"] += 1
+            self.emit(UrlGetter.URL_ERROR, exception=e, url=url)
             
         
     
@@ -73,18 +361,18 @@ if __name__ == '__main__':
 
     getter = UrlGetter()
     
-    def onHttpResult( signal, **named ):
+    def onHttpResult( sender, **named ):
         print '  result', named
-    def onHttpError( signal, **named ):
+    def onHttpError( sender, **named ):
         print '  error', named["exception"]
         raise named["exception"]
-    def onUrlError( signal, **named ):
+    def onUrlError( sender, **named ):
         print '  error', named
     
     
-    dispatcher.connect(onHttpResult, UrlGetter.HTTP_RESULT, getter)
-    dispatcher.connect(onHttpError, UrlGetter.HTTP_ERROR, getter)
-    dispatcher.connect(onUrlError, UrlGetter.URL_ERROR, getter)
+    getter.connect(UrlGetter.HTTP_RESULT, onHttpResult)
+    getter.connect(UrlGetter.HTTP_ERROR, onHttpError)
+    getter.connect(UrlGetter.URL_ERROR, onUrlError)
     print os.getcwd()
 #    getter.get_async("http://localhost/cgi-bin/cgi_test.py", {'mykey' : 'myvalue'})
     getter.get_async("file:messaging.py", {})
@@ -0,0 +1,151 @@
+'''
+This file is part of PySCXML.
+
+    PySCXML is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Lesser General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    PySCXML is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU Lesser General Public License for more details.
+
+    You should have received a copy of the GNU Lesser General Public License
+    along with PySCXML. If not, see <http://www.gnu.org/licenses/>.
+
+    Operational metrics of a MultiSession, in the OpenMetrics text format.
+'''
+
+from bisect import bisect_left
+import messaging
+import offload
+import time
+
+CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+# upper bounds of the buckets for durations, in seconds, and for queue depths.
+TIME_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+DEPTH_BUCKETS = (0, 1, 2, 5, 10, 50, 100, 500, 1000, 5000)
+
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        # the last count is for values above the largest bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, lines):
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append('%s_bucket{le="%s"} %s' % (name, float(bound), cumulative))
+        lines.append('%s_bucket{le="+Inf"} %s' % (name, self.count))
+        lines.append("%s_sum %s" % (name, self.sum))
+        lines.append("%s_count %s" % (name, self.count))
+
+
+class Metrics(object):
+    '''
+    Collects the metrics of the sessions of a MultiSession. The sessions report
+    to it if it's passed as metrics to the MultiSession (or a StateMachine):
+    the external queues report the depth of the queue and the time each event
+    waited in it, and the interpreters report the duration of each macrostep.
+    The remaining metrics are read from the sessions by render.
+    '''
+    def __init__(self):
+        self.created = 0
+        self.exited = 0
+        self.queueDepth = Histogram(DEPTH_BUCKETS)
+        self.eventWait = Histogram(TIME_BUCKETS)
+        self.macrostepTime = Histogram(TIME_BUCKETS)
+
+    def onGet(self, queue, event):
+        '''Called by an EventQueue about to hand out event.'''
+        self.queueDepth.observe(queue.qsize())
+        queued = getattr(event, "queued", None)
+        if queued is not None:
+            self.eventWait.observe(time.time() - queued)
+
+    def onMacrostep(self, elapsed):
+        self.macrostepTime.observe(elapsed)
+
+    def render(self, multisession):
+        '''Returns the metrics of multisession as OpenMetrics text.'''
+        lines = []
+        def family(name, type, help):
+            lines.append("# TYPE %s %s" % (name, type))
+            lines.append("# HELP %s %s" % (name, help))
+
+        sessions = list(multisession)
+        family("pyscxml_sessions", "gauge", "Active sessions.")
+        lines.append("pyscxml_sessions %s" % len(sessions))
+        family("pyscxml_sessions_created", "counter", "Sessions created.")
+        lines.append("pyscxml_sessions_created_total %s" % self.created)
+        family("pyscxml_sessions_exited", "counter", "Sessions that reached a top level final state or were cancelled.")
+        lines.append("pyscxml_sessions_exited_total %s" % self.exited)
+
+        family("pyscxml_session_queue_depth", "gauge", "Events in the external queue of a session.")
+        for sm in sessions:
+            lines.append('pyscxml_session_queue_depth{session="%s"} %s' % (escape(sm.sessionid), sm.interpreter.externalQueue.qsize()))
+        family("pyscxml_session_queue_max_depth", "gauge", "The largest depth of the external queue of a session.")
+        for sm in sessions:
+            stats = sm.interpreter.externalQueue.getStats()
+            lines.append('pyscxml_session_queue_max_depth{session="%s"} %s' % (escape(sm.sessionid), stats["max_depth"]))
+        family("pyscxml_queue_depth", "histogram", "The events left in an external queue when an event is taken from it.")
+        self.queueDepth.render("pyscxml_queue_depth", lines)
+        family("pyscxml_event_wait_seconds", "histogram", "The time an event waited in an external queue.")
+        self.eventWait.render("pyscxml_event_wait_seconds", lines)
+        family("pyscxml_macrostep_seconds", "histogram", "The duration of a macrostep.")
+        self.macrostepTime.render("pyscxml_macrostep_seconds", lines)
+
+        family("pyscxml_delayed_sends", "gauge", "Delayed sends waiting to be sent.")
+        lines.append("pyscxml_delayed_sends %s" % sum(len([t for t in sm.compiler.timer_mapping.values() if not t.dead])
+                                                     for sm in sessions))
+        family("pyscxml_http_sends", "counter", "Outgoing HTTP sends.")
+        lines.append("pyscxml_http_sends_total %s" % messaging.sendStats["requests"])
+        family("pyscxml_http_send_errors", "counter", "Outgoing HTTP sends that failed.")
+        lines.append("pyscxml_http_send_errors_total %s" % messaging.sendStats["errors"])
+        stats = messaging.httpSender.getStats()
+        family("pyscxml_http_send_queue_depth", "gauge", "Outgoing HTTP requests waiting for a connection.")
+        lines.append("pyscxml_http_send_queue_depth %s" % stats["depth"])
+        family("pyscxml_http_send_active", "gauge", "Outgoing HTTP requests in progress.")
+        lines.append("pyscxml_http_send_active %s" % stats["active"])
+        family("pyscxml_http_connections", "gauge", "Open connections of the HTTP sender.")
+        lines.append("pyscxml_http_connections %s" % stats["connections"])
+        family("pyscxml_http_send_retries", "counter", "Outgoing HTTP requests made again after a failure.")
+        lines.append("pyscxml_http_send_retries_total %s" % stats["retried"])
+        family("pyscxml_http_send_rejected", "counter", "Outgoing HTTP requests rejected by a full queue.")
+        lines.append("pyscxml_http_send_rejected_total %s" % stats["rejected"])
+        
+        pools = sorted(offload.pools.items())
+        for key, type, help in (("size", "gauge", "The number of calls an offload pool runs at the same time."),
+                                ("maxqueue", "gauge", "The number of calls that may wait for an offload pool."),
+                                ("running", "gauge", "Calls running in an offload pool."),
+                                ("waiting", "gauge", "Calls waiting for an offload pool."),
+                                ("completed", "counter", "Calls completed by an offload pool."),
+                                ("failed", "counter", "Calls that raised an exception in an offload pool."),
+                                ("rejected", "counter", "Calls rejected by an offload pool with a full queue.")):
+            name = "pyscxml_offload_" + key
+            family(name, type, help)
+            for pool_name, pool in pools:
+                value = pool.getStats()[key]
+                lines.append('%s%s{pool="%s"} %s' % (name, "_total" if type == "counter" else "", 
+                                                     escape(pool_name), value if value is not None else "NaN"))
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+
+def escape(value):
+    '''Escapes value for use as a label value.'''
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+__all__ = ["Metrics", "Histogram", "CONTENT_TYPE"]
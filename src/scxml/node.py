@@ -21,6 +21,9 @@ This file is part of pyscxml.
 
 
 class SCXMLNode(object):
+    __slots__ = ("transition", "state", "final", "history", "onentry", "onexit", "invoke", 
+                 "id", "parent", "n", "initial", "isFirstEntry", "initDatamodel")
+    
     def __init__(self, id, parent, n):
         self.transition = []
         self.state = []
@@ -77,15 +80,22 @@ class SCXMLNode(object):
             
         
 class Executable(object):
+    # no slots of its own, since Initial is also a list.
+    __slots__ = ()
+    
     def __init__(self):
         self.exe = None
 
 class State(SCXMLNode):
+    __slots__ = ()
+    
     def __str__(self):
         return '<State id="%s">' % self.id
         
 
 class Parallel(SCXMLNode):
+    __slots__ = ()
+    
     def __str__(self):
         return '<Parallel id="%s">' % self.id
     
@@ -97,6 +107,8 @@ class Initial(list, Executable):
         
 
 class History(object): 
+    __slots__ = ("id", "parent", "type", "n", "transition")
+    
     def __init__(self, id, parent, type, n):
         self.id = id
         self.parent = parent
@@ -114,12 +126,20 @@ class History(object):
     
 
 class Transition(Executable): 
+    __slots__ = ("exe", "source", "target", "event", "cond", "condExpr", "condDeps", "condPure", "type")
+    
     def __init__(self, source):
         Executable.__init__(self)
         self.source = source
         self.target = []
         self.event = []
         self.cond = None
+        # the (compiled) cond expression, shared by transitions with identical conds.
+        self.condExpr = None
+        # the datamodel names read by cond, if they can be determined.
+        self.condDeps = None
+        # True if cond can't have side effects, so its result may be shared within a selection pass.
+        self.condPure = False
         self.type = "external"
         
     def __str__(self):
@@ -134,6 +154,7 @@ class Transition(Executable):
         return str(self)
  
 class Final(SCXMLNode):
+    __slots__ = ("donedata",)
     
     def __init__(self, id, parent, n):
         SCXMLNode.__init__(self, id, parent, n)
@@ -144,10 +165,14 @@ class Final(SCXMLNode):
 
         
 class Onentry(Executable): 
+    __slots__ = ("exe",)
+    
     def __str__(self):
         return "<Onentry>"
 
 class Onexit(Executable): 
+    __slots__ = ("exe",)
+    
     def __str__(self):
         return "<Onexit>"
 
@@ -158,6 +183,11 @@ class SCXMLDocument(object):
         self._rootState = None
         self.name = ""
         self.binding = None
+        # set to a scxml.codegen.CompiledDocument if the document was precompiled.
+        self.compiled = None
+        # the event descriptors of the document, as tuples of tokens. ("*",) is added 
+        # if the document should see every event, whether a transition matches it or not. 
+        self.eventDescriptors = set()
     
     def setRoot(self, state):
         self._rootState = state
@@ -175,6 +205,12 @@ class SCXMLDocument(object):
     def getState(self, id):
         return self.stateDict.get(id)
     
+    def canConsume(self, tokens):
+        '''True if an event named by the list tokens might be used by this document.'''
+        if ("*",) in self.eventDescriptors:
+            return True
+        return any(tuple(tokens[:i]) in self.eventDescriptors for i in range(1, len(tokens) + 1))
+    
     def __str__(self):
         
         def getDepth(state):
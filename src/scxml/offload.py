@@ -0,0 +1,128 @@
+'''
+This file is part of PySCXML.
+
+    PySCXML is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Lesser General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    PySCXML is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU Lesser General Public License for more details.
+
+    You should have received a copy of the GNU Lesser General Public License
+    along with PySCXML. If not, see <http://www.gnu.org/licenses/>.
+
+    Running blocking custom executables and send types outside of the hub.
+'''
+
+from eventlet import tpool
+from eventlet.queue import Full
+from eventlet.semaphore import Semaphore
+from lxml import etree
+import copy
+import eventlet
+
+# name -> OffloadPool, for every pool created by the custom_executable and
+# custom_sendtype decorators.
+pools = {}
+
+
+class OffloadPool(object):
+    '''
+    Runs functions in eventlet's thread pool (see eventlet.tpool), at most size at
+    a time. At most maxqueue more may wait for their turn, after which submit
+    raises eventlet.queue.Full. The total number of threads shared by all pools is
+    set by the EVENTLET_THREADPOOL_SIZE environment variable (20 by default).
+    '''
+    def __init__(self, size=4, maxqueue=100):
+        self.size = size
+        self.maxqueue = maxqueue
+        self.semaphore = Semaphore(size)
+        self.waiting = 0
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+
+    def submit(self, f, callback):
+        '''
+        Calls f() in a thread and then callback(result, exception) in a greenthread,
+        where exception is None unless f raised one.
+        '''
+        if self.maxqueue is not None and self.waiting >= self.maxqueue:
+            self.rejected += 1
+            raise Full("The offload queue is full.")
+        self.waiting += 1
+        eventlet.spawn(self.run, f, callback)
+
+    def run(self, f, callback):
+        result = exception = None
+        with self.semaphore:
+            self.waiting -= 1
+            self.running += 1
+            try:
+                result = tpool.execute(f)
+                self.completed += 1
+            except Exception, e:
+                exception = e
+                self.failed += 1
+            finally:
+                self.running -= 1
+        callback(result, exception)
+
+    def getStats(self):
+        return {"size" : self.size,
+                "maxqueue" : self.maxqueue,
+                "waiting" : self.waiting,
+                "running" : self.running,
+                "completed" : self.completed,
+                "failed" : self.failed,
+                "rejected" : self.rejected}
+
+
+def offloadExecutable(f, pool):
+    '''
+    Returns a custom executable running f(node, data) in pool. Since the session 
+    goes on while f runs, f doesn't get the element and the datamodel themselves 
+    but a snapshot taken when the element is executed: node is a copy of the 
+    element, and data a dict of copies of the values of the datamodel locations 
+    listed in the namelist attribute of the element, if any. When f returns, the 
+    event done.executable.<name of the element> is put in the external queue of the 
+    session (by way of interpreter.send), with the return value as data, or 
+    error.execution, with the message of the exception as data, if f raised one.
+    '''
+    def execute(node, dm):
+        name = etree.QName(node).localname
+        snapshot = copy.deepcopy(node)
+        data = dict((loc, copy.deepcopy(dm[loc])) for loc in node.get("namelist", "").split())
+        def done(result, exception):
+            if exception is None:
+                dm.self.interpreter.send(["done", "executable", name], result)
+            else:
+                dm.self.interpreter.send(["error", "execution"], str(exception) or type(exception).__name__)
+        pool.submit(lambda: f(snapshot, data), done)
+    return execute
+
+def offloadSendtype(f, pool):
+    '''
+    Returns a custom send type running f(msg, None) in pool, where msg is a copy 
+    of the message, whose data has already been evaluated. The datamodel isn't 
+    passed, since the session goes on while f runs. When f returns, the event 
+    done.send is put in the external queue of the session, with the return value 
+    as data, or error.communication, with the message of the exception as data, 
+    if f raised one, both with the sendid of msg.
+    '''
+    def send(msg, dm):
+        snapshot = copy.deepcopy(msg)
+        def done(result, exception):
+            if exception is None:
+                dm.self.interpreter.send(["done", "send"], result, sendid=msg.sendid or None)
+            else:
+                dm.self.interpreter.send(["error", "communication"], str(exception) or type(exception).__name__, 
+                                         sendid=msg.sendid or None)
+        pool.submit(lambda: f(snapshot, None), done)
+    return send
+
+__all__ = ["OffloadPool", "offloadExecutable", "offloadSendtype", "pools"]
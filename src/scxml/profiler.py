@@ -0,0 +1,75 @@
+'''
+This file is part of PySCXML.
+
+    PySCXML is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Lesser General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    PySCXML is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU Lesser General Public License for more details.
+
+    You should have received a copy of the GNU Lesser General Public License
+    along with PySCXML. If not, see <http://www.gnu.org/licenses/>.
+
+    Counters of the time spent in the parts of a document.
+'''
+
+import json
+import time
+
+# the fields of a counter key, followed by the count and the cumulative seconds.
+FIELDS = ("document", "kind", "state", "line")
+
+
+class Profiler(object):
+    '''
+    Counts how many times, and for how long, each transition, onentry and onexit
+    block, cond and invoke start of a document has run. A counter is keyed by the
+    name of the document, the kind of element, the id of the enclosing state and
+    the line of the element. A Profiler may be shared by several sessions, e.g by
+    passing it to MultiSession.
+    '''
+    def __init__(self):
+        # key -> [count, seconds]
+        self.counters = {}
+        self.started = time.time()
+
+    def record(self, key, elapsed):
+        counter = self.counters.get(key)
+        if counter is None:
+            self.counters[key] = [1, elapsed]
+        else:
+            counter[0] += 1
+            counter[1] += elapsed
+
+    def reset(self):
+        self.counters.clear()
+        self.started = time.time()
+
+    def getSnapshot(self):
+        '''Returns the counters as a list of dicts, the most time consuming first.'''
+        snapshot = []
+        for key, (count, elapsed) in self.counters.items():
+            entry = dict(zip(FIELDS, key))
+            entry["count"] = count
+            entry["time"] = elapsed
+            snapshot.append(entry)
+        snapshot.sort(key=lambda entry: entry["time"], reverse=True)
+        return snapshot
+
+    def dump(self, f):
+        '''Writes the snapshot as JSON to f, a path or a file-like object.'''
+        output = {"started" : self.started,
+                  "duration" : time.time() - self.started,
+                  "counters" : self.getSnapshot()}
+        if isinstance(f, basestring):
+            with open(f, "w") as fp:
+                json.dump(output, fp, indent=1)
+        else:
+            json.dump(output, f, indent=1)
+
+
+__all__ = ["Profiler"]
@@ -19,8 +19,14 @@ This file is part of PySCXML.
 '''
 
 import compiler
+import codegen
+from batch import SessionCohort
 from interpreter import Interpreter
-from louie import dispatcher
+from eventqueue import EventQueue
+from logsink import formatValue
+from offload import OffloadPool, offloadExecutable, offloadSendtype
+import offload
+from signals import Signaller
 import logging
 import os
 import eventlet
@@ -34,33 +40,41 @@ import sys
 import time
 from scxml.interpreter import CancelEvent
 
+# shared by all sessions, see SessionLogger.
+sessionLogger = logging.getLogger("pyscxml.session")
+interpreterLogger = logging.getLogger("pyscxml.interpreter")
+compilerLogger = logging.getLogger("pyscxml.compiler")
+
+class SessionLogger(logging.LoggerAdapter):
+    '''
+    Logs to a logger shared by all sessions, prefixing messages with the sessionid, 
+    which is also set as the sessionid attribute of the log records. Unlike a 
+    logger per session, the adapter is collected along with the session.
+    '''
+    def __init__(self, logger, sessionid):
+        logging.LoggerAdapter.__init__(self, logger, {"sessionid" : sessionid})
+        self.prefix = "%s: " % sessionid
+    
+    def process(self, msg, kwargs):
+        kwargs["extra"] = self.extra
+        return (self.prefix + msg if isinstance(msg, basestring) else msg), kwargs
+    
+    def warn(self, msg, *args, **kwargs):
+        self.warning(msg, *args, **kwargs)
+
 def default_logfunction(label, msg):
     label = label or ""
 #    msg = msg or ""
-    
-    def f(x):
-        if etree.iselement(x):
-            return etree.tostring(x).strip()
-        elif isinstance(x, etree._ElementStringResult):
-            return str(x)
-        
-        return x
-    
-    if isinstance(msg, list):
-        msg = map(f, msg)
-        try:
-            msg = "\n".join(msg)
-        except:
-            msg = str(msg)
+    msg = formatValue(msg)
     print "%s%s%s" % (label, ": " if label and msg is not None else "", msg)
 
 
-class StateMachine(object):
+class StateMachine(Signaller):
     '''
     This class provides the entry point for the PySCXML library. 
     '''
     
-    def __init__(self, source, log_function=default_logfunction, sessionid=None, default_datamodel="python", setup_session=True):
+    def __init__(self, source, log_function=default_logfunction, sessionid=None, default_datamodel="python", setup_session=True, precompile=False, quantum_events=1, quantum_time=None, queue_options=None, log_sink=None, profiler=None, tracer=None, metrics=None, watchdog=None, discard_unused_events=False):
         '''
         @param source: the scxml document to parse. source may be either:
         
@@ -78,12 +92,39 @@ class StateMachine(object):
             
         @param log_function: the function to execute on a <log /> element. 
         signature is f(label, msg), where label is a string and msg a string.
+        @param log_sink: a scxml.logsink.LogSink that the output of <log> elements is 
+        handed to instead of being passed to log_function, e.g logsink.FileSink(sys.stdout). 
+        Sessions invoked by this one log to the same sink.
         @param sessionid: is stored in the _session variable. Will be automatically
         generated if not provided.
         @param default_datamodel: if omitted, any document started by this instance will have 
         its datamodel expressions evaluated as Python expressions. Set to 'ecmascript' to assume 
         EMCAScript expressions.
         @param setup_session: for internal use.
+        @param precompile: if True, transition selection and the exit and entry sets
+        of transitions are generated as a Python module (see scxml.codegen), which is 
+        shared by all StateMachine instances running the same document.
+        @param quantum_events: the number of macrosteps the session may run before it 
+        yields to other sessions, if events are waiting in its external queue. 
+        None means no limit.
+        @param quantum_time: if set, the session also yields after quantum_time 
+        milliseconds of work. 
+        @param queue_options: keyword arguments for the scxml.eventqueue.EventQueue 
+        used as the external queue of the session, e.g {"maxsize" : 1000, "policy" : "drop_oldest"}.
+        @param profiler: a scxml.profiler.Profiler, which then counts the time spent in 
+        each transition, onentry and onexit block, cond and invoke start of the document.
+        @param tracer: a scxml.tracer.Tracer, which then records the macrosteps, microsteps, 
+        blocks of executable content and sends of the session. 
+        @param metrics: a scxml.metrics.Metrics, which the external queue and the 
+        macrosteps of the session are then reported to.
+        @param watchdog: a scxml.watchdog.Watchdog, which then reports macrosteps and 
+        executable content of the session that keep other sessions from running. 
+        It's started if it isn't already.
+        @param discard_unused_events: if True, external events sent to the session 
+        (by send, <send> or an offloaded executable) that no transition of the document 
+        can match are dropped instead of queued. Such an event is then invisible to 
+        <script> and to conds that read _event by way of a function call, and 
+        unhandled error events are lost without a trace.
         @raise IOError 
         @raise xml.parsers.expat.ExpatError 
         '''
@@ -94,15 +135,33 @@ class StateMachine(object):
         self.compiler = compiler.Compiler()
         self.compiler.default_datamodel = default_datamodel
         self.compiler.log_function = log_function
+        self.compiler.log_sink = log_sink
+        self.compiler.profiler = profiler
+        self.compiler.tracer = tracer
         
         
         self.sessionid = sessionid or "pyscxml_session_" + str(id(self))
         self.interpreter = Interpreter()
-        dispatcher.connect(self.on_exit, "signal_exit", self.interpreter)
-        self.logger = logging.getLogger("pyscxml.%s" % self.sessionid)
-        self.interpreter.logger = logging.getLogger("pyscxml.%s.interpreter" % self.sessionid)
-        self.compiler.logger = logging.getLogger("pyscxml.%s.compiler" % self.sessionid)
-        self.doc = self.compiler.parseXML(self._open_document(source), self.interpreter)
+        self.interpreter.quantumEvents = quantum_events
+        self.interpreter.quantumTime = quantum_time
+        self.interpreter.discardUnusedEvents = discard_unused_events
+        self.interpreter.tracer = tracer
+        self.interpreter.metrics = metrics
+        self.interpreter.watchdog = watchdog
+        self.compiler.watchdog = watchdog
+        if watchdog:
+            watchdog.start()
+        if queue_options:
+            self.interpreter.externalQueue = EventQueue(**queue_options)
+        self.interpreter.externalQueue.metrics = metrics
+        self.interpreter.connect("signal_exit", self.on_exit)
+        self.logger = SessionLogger(sessionLogger, self.sessionid)
+        self.interpreter.logger = SessionLogger(interpreterLogger, self.sessionid)
+        self.compiler.logger = SessionLogger(compilerLogger, self.sessionid)
+        xml = self._open_document(source)
+        self.doc = self.compiler.parseXML(xml, self.interpreter)
+        if precompile:
+            self.doc.compiled = codegen.load(self.doc, xml)
         self.interpreter.dm = self.doc.datamodel
         self.datamodel = self.doc.datamodel
         self.doc.datamodel["_x"] = {"self" : self}
@@ -179,6 +238,7 @@ class StateMachine(object):
         Send an event to the running machine. 
         @param name: the event name (string)
         @param data: the data passed to the _event.data variable (any data type)
+        @raise eventlet.queue.Full: if the external queue is full and its policy is 'error'.
         '''
         self._send(name, data)
         eventlet.greenthread.sleep()
@@ -200,8 +260,8 @@ class StateMachine(object):
             for timer in self.compiler.timer_mapping.values():
                 eventlet.greenthread.cancel(timer)
                 del timer
-            dispatcher.disconnect(self, "signal_exit", self.interpreter)
-            dispatcher.send("signal_exit", self, final=final)
+            self.interpreter.disconnect("signal_exit", self.on_exit)
+            self.emit("signal_exit", final=final)
     
     
     def __enter__(self):
@@ -215,7 +275,7 @@ class StateMachine(object):
 
 class MultiSession(object):
     
-    def __init__(self, default_scxml_source=None, init_sessions={}, default_datamodel="python", log_function=default_logfunction):
+    def __init__(self, default_scxml_source=None, init_sessions={}, default_datamodel="python", log_function=default_logfunction, precompile=False, quantum_events=1, quantum_time=None, queue_options=None, log_sink=None, profiler=None, tracer=None, metrics=None, watchdog=None, discard_unused_events=False):
         '''
         MultiSession is a local runtime environment for multiple StateMachine sessions. It's 
         the base class for the PySCXMLServer. You probably won't need to instantiate it directly. 
@@ -226,12 +286,29 @@ class MultiSession(object):
         make_session(key, value) on each init_sessions pair, thus initalizing 
         a set of sessions. Set value to None as a shorthand for deferring to the 
         default xml for that session. 
+        @param precompile, quantum_events, quantum_time, queue_options, log_sink, profiler, 
+        tracer, metrics, watchdog, discard_unused_events: passed on to each StateMachine created by this instance. The
+        sessions created and exited are also counted by metrics.
         '''
         self.default_scxml_source = default_scxml_source
         self.sm_mapping = {}
         self.get = self.sm_mapping.get
         self.default_datamodel = default_datamodel
         self.log_function = log_function
+        self.precompile = precompile
+        self.quantum_events = quantum_events
+        self.quantum_time = quantum_time
+        self.queue_options = queue_options
+        self.log_sink = log_sink
+        self.profiler = profiler
+        self.tracer = tracer
+        self.metrics = metrics
+        self.watchdog = watchdog
+        self.discard_unused_events = discard_unused_events
+        # precompiled sessions, grouped by document
+        self.cohorts = {}
+        # event descriptor -> the sessions that aren't in a cohort whose document uses it
+        self.subscriptions = {}
         self.logger = logging.getLogger("pyscxml.multisession")
         for sessionid, xml in init_sessions.items():
             self.make_session(sessionid, xml)
@@ -241,7 +318,8 @@ class MultiSession(object):
         return iter(list(self.sm_mapping.itervalues()))
     
     def __delitem__(self, val):
-        del self.sm_mapping[val]
+        sm = self.sm_mapping.pop(val)
+        self.unsubscribe(sm)
     
     def __getitem__(self, val):
         return self.sm_mapping[val]
@@ -269,20 +347,43 @@ class MultiSession(object):
         not been started, only initialized.
          '''
         assert source or self.default_scxml_source
+        source = source or self.default_scxml_source
         if isinstance(source, basestring):
-            sm = StateMachine(source or self.default_scxml_source,
+            sm = StateMachine(source,
                                 sessionid=sessionid,
                                 default_datamodel=self.default_datamodel,
                                 setup_session=False,
-                                log_function=self.log_function)
+                                log_function=self.log_function,
+                                precompile=self.precompile,
+                                quantum_events=self.quantum_events,
+                                quantum_time=self.quantum_time,
+                                queue_options=self.queue_options,
+                                log_sink=self.log_sink,
+                                profiler=self.profiler,
+                                tracer=self.tracer,
+                                metrics=self.metrics,
+                                watchdog=self.watchdog,
+                                discard_unused_events=self.discard_unused_events)
         else:
             sm = source # source is assumed to be a StateMachine instance
+        if sessionid in self.sm_mapping:
+            self.unsubscribe(self.sm_mapping[sessionid])
         self.sm_mapping[sessionid] = sm
         #TODO: fix this.
 #        if not isinstance(sm.datamodel, XPathDatamodel):
         sm.datamodel.sessions = self
         self.set_processors(sm)
-        dispatcher.connect(self.on_sm_exit, "signal_exit", sm)
+        if sm.doc.compiled:
+            module = sm.doc.compiled.module
+            if module not in self.cohorts:
+                self.cohorts[module] = SessionCohort(sm.doc)
+            self.cohorts[module].add(sm)
+        else:
+            for descriptor in sm.doc.eventDescriptors:
+                self.subscriptions.setdefault(descriptor, set()).add(sm)
+        sm.connect("signal_exit", self.on_sm_exit)
+        if self.metrics:
+            self.metrics.created += 1
         return sm
     
     def set_processors(self, sm):
@@ -296,18 +397,47 @@ class MultiSession(object):
     
     def send(self, event, data={}, to_session=None):
         '''send an event to the specified session. if to_session is None or "", 
-        the event is sent to all active sessions.'''
+        the event is sent to the active sessions whose document might consume it.
+        Precompiled sessions are further filtered by their current configuration 
+        (see scxml.batch.SessionCohort).'''
         if to_session:
             self[to_session].send(event, data)
         else:
-            for session in self.sm_mapping:
-                self.sm_mapping[session].send(event, data)
+            for sm in self.getReceivers(event):
+                sm._send(event, data)
+            eventlet.greenthread.sleep()
+    
+    def getReceivers(self, event):
+        '''Returns the sessions a broadcast of event should be sent to.'''
+        name = ".".join(event) if isinstance(event, list) else event
+        tokens = name.split(".")
+        receivers = set(self.subscriptions.get(("*",), ()))
+        for i in range(1, len(tokens) + 1):
+            receivers.update(self.subscriptions.get(tuple(tokens[:i]), ()))
+        receivers = list(receivers)
+        for cohort in self.cohorts.values():
+            receivers.extend(cohort.getReceivers(name))
+        return receivers
+    
+    def unsubscribe(self, sm):
+        sm.disconnect("signal_exit", self.on_sm_exit)
+        if sm.interpreter.cohort:
+            sm.interpreter.cohort.remove(sm)
+            return
+        for descriptor in sm.doc.eventDescriptors:
+            sessions = self.subscriptions.get(descriptor)
+            if sessions is None: continue
+            sessions.discard(sm)
+            if not sessions:
+                del self.subscriptions[descriptor]
     
     def cancel(self):
         for sm in self:
             sm.cancel()
     
     def on_sm_exit(self, sender, final):
+        if self.metrics:
+            self.metrics.exited += 1
         if sender.sessionid in self:
             self.logger.debug("The session '%s' finished" % sender.sessionid)
             del self[sender.sessionid]
@@ -324,21 +454,46 @@ class MultiSession(object):
         eventlet.greenthread.sleep()
 
 class custom_executable(object):
-    '''A decorator for defining custom executable content'''
-    def __init__(self, namespace):
+    '''
+    A decorator for defining custom executable content. 
+    
+    If offload is True, the function is run in a thread instead of in the session, 
+    which continues without waiting for it (see scxml.offload.offloadExecutable for the 
+    events the session gets when it's done). The function is then called with a copy of 
+    the element and a dict of copies of the datamodel values named by its namelist 
+    attribute instead of the datamodel, so its results only reach the session through 
+    those events. At most pool_size calls run at the same time and at most max_queue 
+    more are queued, beyond which the element fails with error.execution. 
+    '''
+    def __init__(self, namespace, offload=False, pool_size=4, max_queue=100):
         self.namespace = namespace
+        self.pool = OffloadPool(pool_size, max_queue) if offload else None
     
     def __call__(self, f):
-        compiler.custom_exec_mapping[self.namespace] = f
+        if self.pool:
+            offload.pools[self.namespace] = self.pool
+            compiler.custom_exec_mapping[self.namespace] = offloadExecutable(f, self.pool)
+        else:
+            compiler.custom_exec_mapping[self.namespace] = f
         return f
 
 class custom_sendtype(object):
-    '''A decorator for defining custom send types'''
-    def __init__(self, sendtype):
+    '''
+    A decorator for defining custom send types. offload, pool_size and max_queue are 
+    as for custom_executable (see scxml.offload.offloadSendtype for the events), except 
+    that an offloaded function gets a copy of the message and None for the datamodel, 
+    and a send rejected by a full queue fails with error.communication.
+    '''
+    def __init__(self, sendtype, offload=False, pool_size=4, max_queue=100):
         self.sendtype = sendtype
+        self.pool = OffloadPool(pool_size, max_queue) if offload else None
 
     def __call__(self, fun):
-        compiler.custom_sendtype_mapping[self.sendtype] = fun
+        if self.pool:
+            offload.pools[self.sendtype] = self.pool
+            compiler.custom_sendtype_mapping[self.sendtype] = offloadSendtype(fun, self.pool)
+        else:
+            compiler.custom_sendtype_mapping[self.sendtype] = fun
         return fun
     
 #class preprocessor(object):
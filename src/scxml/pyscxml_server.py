@@ -19,24 +19,31 @@ Created on Dec 15, 2010
 @author: Johan Roxendal
 '''
 
-from eventprocessor import SCXMLEventProcessor as Processor, Event
+from eventprocessor import SCXMLEventProcessor as Processor, Event, JSON_CONTENT_TYPE
 from scxml.pyscxml import MultiSession
 from xml.parsers.expat import ExpatError
 import cgi
+import json
 import logging
 import eventlet
 from StringIO import StringIO
+from eventlet.queue import Full
 import os, urllib
 from pprint import pprint
 from scxml.datamodel import XPathDatamodel
+from scxml.metrics import Metrics, CONTENT_TYPE as METRICS_CONTENT_TYPE
 
 handler_mapping = {}
 
+# the first segment of the paths served by the server itself, rather than by a session.
+RESERVED_PATH = "_pyscxml"
+
 
 class PySCXMLServer(MultiSession):
     
     def __init__(self, host, port, default_scxml_source=None, init_sessions={}, 
-                 session_path="/", default_datamodel="python"):
+                 session_path="/", default_datamodel="python", metrics=True, 
+                 ack_after_macrostep=False, ack_timeout=30, stream=False):
         '''
         @param host: the hostname on which to serve.
         @param port: the port on which to serve.
@@ -51,6 +58,22 @@ class PySCXMLServer(MultiSession):
         constructor and started as serve_forever() is called. Any key with the value of None 
         will instead execute the default_scxml_source. If default_scxml_source is None and a value 
         in init_sessions is None, AssertionError will be raised.    
+        @param metrics: if True, the metrics of the sessions are collected by a 
+        scxml.metrics.Metrics instance and served as OpenMetrics text at /_pyscxml/metrics. 
+        A Metrics instance may also be passed. The paths under /_pyscxml/ are reserved 
+        for the server, so no session may be called _pyscxml.
+        @param ack_after_macrostep: the events of a request are put in the external 
+        queue of their session before the request is answered, so a client that waits 
+        for each answer has its events processed in the order it sent them. If 
+        ack_after_macrostep is True, the request is instead answered once the session 
+        has processed its (last) event, with 410 GONE if the session exited first and 
+        504 GATEWAY TIMEOUT if that took more than ack_timeout seconds. A request whose 
+        event doesn't fit in the queue of its session is answered with 503 SERVICE UNAVAILABLE, 
+        as is a request waiting for an event that the queue then dropped or let expire. 
+        A batch of events is refused as a whole if the queue can't take all of them.
+        @param stream: if True, events for any session may be streamed to /_pyscxml/stream 
+        (see stream_handler). Off by default, since it lets a single request start sessions 
+        and send them events.
         
         WARNING: this documentation is deprecated, since server_forever no longer exists. i'll fix this soon.
         Example:
@@ -69,11 +92,19 @@ class PySCXMLServer(MultiSession):
         
         
         '''
+        if RESERVED_PATH in init_sessions:
+            raise ValueError("The sessionid '%s' is reserved for the server." % RESERVED_PATH)
         self.session_path = session_path.strip("/") + "/"
         self.logger = logging.getLogger("pyscxml.pyscxml_server")
         self.host = host
         self.port = port
-        MultiSession.__init__(self, default_scxml_source, init_sessions, default_datamodel)
+        self.ack_after_macrostep = ack_after_macrostep
+        self.ack_timeout = ack_timeout
+        self.streaming = stream
+        if metrics is True:
+            metrics = Metrics()
+        MultiSession.__init__(self, default_scxml_source, init_sessions, default_datamodel, 
+                              metrics=metrics or None)
             
         self.start()
         
@@ -98,8 +129,10 @@ class PySCXMLServer(MultiSession):
     
     def request_handler(self, environ, start_response):
         status = '200 OK'
+        pathlist = filter(bool, environ.get("PATH_INFO", "").split("/"))
+        if pathlist[:1] == [RESERVED_PATH]:
+            return self.server_handler(pathlist[1:], environ, start_response)
         try:
-            pathlist = filter(bool, environ["PATH_INFO"].split("/"))
             session = pathlist[0]
             type = pathlist[1]
         except Exception, e:
@@ -138,14 +171,37 @@ class PySCXMLServer(MultiSession):
                 self.logger.error("Error when looking up handler for type %s." % type)
                 raise
                 
+            if isinstance(event, list): # a batch of events, enqueued in order
+                if sm.is_response:
+                    raise ValueError("A batch of events can't be sent to a session that responds.")
+                events = event
+            else:
+                events = [event]
+            
             if sm.is_response:
                 sm.interpreter.externalQueue.put(event)
                 output, headers = sm.datamodel.response.get() #blocks
                 start_response(status, headers.items())
             else:
-                eventlet.spawn_after(0.1, sm.interpreter.externalQueue.put, event)
+                # a batch is refused as a whole rather than partly enqueued.
+                if not sm.interpreter.externalQueue.canTake(len(events)):
+                    raise Full("The event queue can't take %s events." % len(events))
+                ack = events and self.ack_after_macrostep and sm.interpreter.whenProcessed(events[-1])
+                try:
+                    for event in events:
+                        sm.interpreter.externalQueue.put(event)
+                except Full:
+                    if ack:
+                        sm.interpreter.cancelAck(ack)
+                    raise
+                if ack:
+                    status = self.wait_ack(sm, events[-1], ack)
                 start_response(status, headers.items())
             
+        except Full:
+            self.logger.warning("The event queue of session %s is full." % session)
+            status = '503 SERVICE UNAVAILABLE'
+            start_response(status, headers.items())
         except AssertionError:
             self.logger.error("No default xml is declared, so sessions can't be dynamically initialized.")
             status = '403 FORBIDDEN'
@@ -153,8 +209,79 @@ class PySCXMLServer(MultiSession):
             self.logger.error("Parsing of incoming scxml message failed for message %s" % fs.getvalue("_content") )
             status = '400 BAD REQUEST'
             output = str(e)
+        except ValueError, e:
+            self.logger.error(str(e))
+            status = '400 BAD REQUEST'
+            start_response(status, headers.items())
+            output = str(e)
         
         return [output]
+    
+    def server_handler(self, pathlist, environ, start_response):
+        '''Serves the paths under /_pyscxml/, with the part after it in pathlist.'''
+        if self.metrics and pathlist == ["metrics"]:
+            start_response('200 OK', [('Content-type', METRICS_CONTENT_TYPE)])
+            return [self.metrics.render(self)]
+        if self.streaming and pathlist == ["stream"]:
+            return self.stream_handler(environ, start_response)
+        start_response('404 NOT FOUND', [('Content-type', 'text/plain')])
+        return [""]
+    
+    def stream_handler(self, environ, start_response):
+        '''
+        Serves /_pyscxml/stream if the server was created with stream=True. 
+        Takes SCXML messages in JSON (see SCXMLEventProcessor.tojson), one per line, 
+        for as long as the request lasts (e.g using chunked transfer encoding). Each 
+        message holds the id of the session it's for under "session". The event is put 
+        in the external queue of that session as soon as its line is read, so the 
+        events for a session are processed in the order of the lines. A session with 
+        a full queue that blocks holds up the rest of the stream. 
+        
+        A JSON line is written back for each message: {"line" : n, "ok" : true} 
+        or {"line" : n, "error" : reason} if the event was refused.
+        '''
+        # write each acknowledgement as soon as it's made
+        environ["eventlet.minimum_write_chunk_size"] = 0
+        start_response('200 OK', [('Content-type', JSON_CONTENT_TYPE)])
+        return self.stream(environ["wsgi.input"])
+    
+    def stream(self, input):
+        n = 0
+        for line in iter(input.readline, ""):
+            if not line.strip(): continue
+            n += 1
+            yield json.dumps(self.stream_line(n, line)) + "\n"
+    
+    def stream_line(self, n, line):
+        try:
+            msg = json.loads(line)
+            if msg["session"] == RESERVED_PATH:
+                raise ValueError("The sessionid '%s' is reserved for the server." % RESERVED_PATH)
+            sm = self.get(msg["session"]) or self.init_session(msg["session"])
+            if sm.is_response:
+                raise ValueError("Session '%s' responds to its events, so it can't be streamed to." % msg["session"])
+            event = Processor.fromdict(msg)
+            event.type = "HTTP"
+            sm.interpreter.externalQueue.put(event)
+        except AssertionError:
+            return {"line" : n, "error" : "No default xml is declared, so sessions can't be dynamically initialized."}
+        except Exception, e:
+            return {"line" : n, "error" : str(e) or e.__class__.__name__}
+        return {"line" : n, "ok" : True}
+    
+    def wait_ack(self, sm, event, ack):
+        '''Waits for the macrostep of event to finish, and returns the status to answer with.'''
+        timedOut = True
+        with eventlet.Timeout(self.ack_timeout, False):
+            processed = ack.wait()
+            timedOut = False
+        if timedOut:
+            sm.interpreter.cancelAck(ack)
+            return '504 GATEWAY TIMEOUT'
+        if processed is None:
+            # dropped or expired in the queue
+            return '503 SERVICE UNAVAILABLE'
+        return '200 OK' if processed else '410 GONE'
 
 
 class WebsocketWSGI(PySCXMLServer):
@@ -228,6 +355,20 @@ def type_basichttp(session, data, sm, environ, raw=None):
 
 @ioprocessor('scxml')
 def type_scxml(session, data, sm, environ, raw=None):
+    '''
+    Handles a single SCXML message, or a batch of them made by scxml.messaging.SendBatcher, 
+    in XML or, if the content type is JSON_CONTENT_TYPE, in JSON. 
+    '''
+    if environ.get("CONTENT_TYPE", "").startswith(JSON_CONTENT_TYPE):
+        events = Processor.fromjson(data)
+        for event in events:
+            event.type = "HTTP"
+        return events[0] if len(events) == 1 else events
+    if Processor.isBatch(data):
+        events = Processor.fromBatch(data)
+        for event in events:
+            event.type = "HTTP"
+        return events
     event = Processor.fromxml(data)
     event.type = "HTTP"
     
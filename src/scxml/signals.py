@@ -0,0 +1,88 @@
+'''
+This file is part of PySCXML.
+
+    PySCXML is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Lesser General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    PySCXML is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU Lesser General Public License for more details.
+
+    You should have received a copy of the GNU Lesser General Public License
+    along with PySCXML. If not, see <http://www.gnu.org/licenses/>.
+
+    Signals sent by interpreters, sessions, invokes and UrlGetters, such as
+    signal_exit. The listeners are kept by the sender, so they are collected
+    along with it.
+
+    Earlier versions sent these signals through louie.dispatcher only. They still 
+    are, if louie is installed, so listeners connected with dispatcher.connect keep 
+    working, but that is deprecated: a warning is logged the first time a signal 
+    reaches such a listener. Connect to the sender instead (see Signaller.connect), 
+    noting that the listener is then called as listener(sender, **named), without 
+    the signal. enableLouie(False) stops sending signals through louie.
+'''
+
+import logging
+
+try:
+    from louie import dispatcher
+except ImportError:
+    dispatcher = None
+
+# if True, every signal is also sent through louie.dispatcher (deprecated).
+louieCompatible = dispatcher is not None
+louieWarned = False
+
+def enableLouie(enabled=True):
+    '''Turns sending every signal through louie.dispatcher on or off.'''
+    global louieCompatible
+    if enabled and dispatcher is None:
+        raise ImportError("louie isn't installed.")
+    louieCompatible = enabled
+
+
+class Signaller(object):
+    '''
+    A mixin for objects sending signals. A listener connected to a signal is called
+    with the sender as its only positional argument and the keyword arguments
+    of the signal, e.g listener(sm, final="f") for signal_exit. (A louie listener 
+    may also receive the signal, as the keyword argument signal.)
+    '''
+    listeners = None
+
+    def connect(self, signal, listener):
+        if self.listeners is None:
+            self.listeners = {}
+        self.listeners.setdefault(signal, []).append(listener)
+
+    def disconnect(self, signal, listener=None):
+        '''Disconnects listener, or all listeners of signal if listener is None.'''
+        if not self.listeners or signal not in self.listeners:
+            return
+        if listener is None:
+            del self.listeners[signal]
+            return
+        listeners = self.listeners[signal]
+        if listener in listeners:
+            listeners.remove(listener)
+        if not listeners:
+            del self.listeners[signal]
+
+    def emit(self, signal, **named):
+        if self.listeners and signal in self.listeners:
+            for listener in list(self.listeners[signal]):
+                listener(self, **named)
+        if louieCompatible:
+            global louieWarned
+            responses = dispatcher.send(signal, self, **named)
+            if responses and not louieWarned:
+                louieWarned = True
+                logging.getLogger("pyscxml.signals").warning("Receiving the signal %s through louie.dispatcher "
+                    "is deprecated, connect to its sender instead (see scxml.signals.Signaller.connect)." % signal)
+
+
+__all__ = ["Signaller", "enableLouie"]
@@ -0,0 +1,74 @@
+'''
+This file is part of PySCXML.
+
+    PySCXML is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Lesser General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    PySCXML is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU Lesser General Public License for more details.
+
+    You should have received a copy of the GNU Lesser General Public License
+    along with PySCXML. If not, see <http://www.gnu.org/licenses/>.
+
+    Traces of the steps taken by sessions, in the Chrome trace event format
+    (open the output of Tracer.dump in chrome://tracing or ui.perfetto.dev).
+'''
+
+from collections import deque
+import json
+import os
+import time
+
+
+class Tracer(object):
+    '''
+    Records spans for the macrosteps and microsteps of sessions, the exitStates,
+    executeTransitionContent and enterStates phases of each microstep, each block of
+    executable content and each outgoing send. Only the last capacity spans are
+    kept, so a Tracer may stay on in a long running process. A Tracer may be shared
+    by several sessions, e.g by passing it to MultiSession; each session is shown
+    as a thread of its own.
+    '''
+    def __init__(self, capacity=100000):
+        # (name, sessionid, start, duration, args)
+        self.spans = deque(maxlen=capacity)
+        self.pid = os.getpid()
+
+    def span(self, name, sessionid, start, args=None):
+        '''Records the span name, from start until now.'''
+        self.spans.append((name, sessionid, start, time.time() - start, args))
+
+    def clear(self):
+        self.spans.clear()
+
+    def getEvents(self):
+        '''Returns the recorded spans as a list of trace events.'''
+        tids = {}
+        events = []
+        for name, sessionid, start, duration, args in list(self.spans):
+            if sessionid not in tids:
+                tids[sessionid] = len(tids) + 1
+                events.append({"name" : "thread_name", "ph" : "M", "pid" : self.pid,
+                               "tid" : tids[sessionid], "args" : {"name" : sessionid}})
+            event = {"name" : name, "cat" : "scxml", "ph" : "X", "pid" : self.pid,
+                     "tid" : tids[sessionid], "ts" : start * 1e6, "dur" : duration * 1e6}
+            if args:
+                event["args"] = args
+            events.append(event)
+        return events
+
+    def dump(self, f):
+        '''Writes the trace as JSON to f, a path or a file-like object.'''
+        output = {"traceEvents" : self.getEvents(), "displayTimeUnit" : "ms"}
+        if isinstance(f, basestring):
+            with open(f, "w") as fp:
+                json.dump(output, fp)
+        else:
+            json.dump(output, f)
+
+
+__all__ = ["Tracer"]
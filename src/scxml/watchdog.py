@@ -0,0 +1,140 @@
+'''
+This file is part of PySCXML.
+
+    PySCXML is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Lesser General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    PySCXML is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU Lesser General Public License for more details.
+
+    You should have received a copy of the GNU Lesser General Public License
+    along with PySCXML. If not, see <http://www.gnu.org/licenses/>.
+
+    Detection of code that keeps the eventlet hub from running other sessions.
+'''
+
+from collections import deque
+from eventlet import patcher
+from eventlet.hubs import get_hub
+import greenlet
+import logging
+import sys
+import traceback
+
+threading = patcher.original("threading")
+time = patcher.original("time")
+
+
+class Watchdog(object):
+    '''
+    Reports any greenthread that runs for longer than threshold seconds without
+    yielding to the hub, since no other session can run in the meantime. The
+    check is made from a thread of its own, so a report is made while the
+    greenthread is still blocking. It holds the session, the kind of activity
+    (a macrostep, a block of executable content, a <script> or a custom
+    executable) and the line of the innermost activity registered by the
+    blocking greenthread, if any, as well as the stack of the blocking code.
+    Reports are logged as warnings to the 'pyscxml.watchdog' logger and kept
+    in self.reports.
+
+    If timeout_error is True, a block of executable content that took longer than
+    threshold also raises the event error.execution.timeout in its session once
+    it has finished (blocking code can't be interrupted safely).
+    '''
+    def __init__(self, threshold=1.0, timeout_error=False, maxreports=100):
+        self.threshold = threshold
+        self.timeoutError = timeout_error
+        self.reports = deque(maxlen=maxreports)
+        self.logger = logging.getLogger("pyscxml.watchdog")
+        # greenlet -> the activities it has entered, innermost last, as
+        # lists of [kind, sessionid, line, start]
+        self.active = {}
+        # the greenlet last switched to, and when
+        self.running = None
+        self.switched = time.time()
+        self.reported = None
+        self.previousTrace = None
+        self.mainThread = None
+        self.thread = None
+
+    def start(self):
+        '''Starts watching the hub of the calling thread. Does nothing if already started.'''
+        if self.thread is not None:
+            return
+        self.hub = get_hub()
+        self.mainThread = threading.current_thread().ident
+        self.running = greenlet.getcurrent()
+        self.switched = time.time()
+        self.previousTrace = greenlet.settrace(self.onSwitch)
+        self.thread = threading.Thread(target=self.watch, name="pyscxml watchdog")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        greenlet.settrace(self.previousTrace)
+        self.previousTrace = None
+        thread, self.thread = self.thread, None
+        thread.join()
+
+    def onSwitch(self, event, args):
+        if event in ("switch", "throw"):
+            self.running = args[1]
+            self.switched = time.time()
+        if self.previousTrace:
+            self.previousTrace(event, args)
+
+    def enter(self, kind, sessionid, line):
+        '''Marks the start of an activity of the current greenthread.'''
+        self.active.setdefault(greenlet.getcurrent(), []).append([kind, sessionid, line, time.time()])
+
+    def leave(self):
+        '''Marks the end of the innermost activity of the current greenthread and returns its duration.'''
+        current = greenlet.getcurrent()
+        stack = self.active.get(current)
+        if not stack:
+            return 0
+        start = stack.pop()[3]
+        if not stack:
+            del self.active[current]
+        return time.time() - start
+
+    def watch(self):
+        thread = self.thread
+        while self.thread is thread:
+            time.sleep(self.threshold / 4.0)
+            self.check()
+
+    def check(self):
+        self.prune()
+        running, switched = self.running, self.switched
+        blocked = time.time() - switched
+        if running is self.hub.greenlet or switched == self.reported or blocked < self.threshold:
+            return
+        self.reported = switched
+        stack = list(self.active.get(running) or ())
+        kind, sessionid, line = stack[-1][:3] if stack else (None, None, None)
+        frame = sys._current_frames().get(self.mainThread)
+        report = {"session" : sessionid,
+                  "kind" : kind,
+                  "line" : line,
+                  "blocked" : blocked,
+                  "stack" : "".join(traceback.format_stack(frame)) if frame else ""}
+        self.reports.append(report)
+        self.logger.warning("The hub has been blocked for %.3f s by %s of session %s on line %s:\n%s",
+                            blocked, kind or "code", sessionid, line, report["stack"])
+
+    
+    def prune(self):
+        '''Forgets the activities of greenthreads that died without leaving them, e.g when killed.'''
+        for g in self.active.keys():
+            if g.dead:
+                self.active.pop(g, None)
+
+
+__all__ = ["Watchdog"]
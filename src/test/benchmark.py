@@ -0,0 +1,157 @@
+'''
+This file is part of pyscxml.
+
+    pyscxml is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Lesser General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    pyscxml is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Lesser General Public License for more details.
+
+    You should have received a copy of the GNU Lesser General Public License
+    along with pyscxml.  If not, see <http://www.gnu.org/licenses/>.
+
+Micro benchmarks for the event path. Run from this directory with
+PYTHONPATH=.. python benchmark.py
+'''
+
+import sys
+import time
+import eventlet
+from StringIO import StringIO
+from scxml.pyscxml import StateMachine, MultiSession
+from scxml.pyscxml_server import PySCXMLServer
+from scxml.eventprocessor import Event, SCXMLEventProcessor as Processor, XML_CONTENT_TYPE, JSON_CONTENT_TYPE
+
+
+def eventSize():
+    '''The bytes held by an Event instance, not counting its field values.'''
+    e = Event("position.update", {"x" : 1})
+    size = sys.getsizeof(e)
+    if hasattr(e, "__dict__"):
+        size += sys.getsizeof(e.__dict__)
+    return size
+
+def eventAllocation(n=100000):
+    '''Events created per second.'''
+    start = time.time()
+    for i in xrange(n):
+        Event("position.update", {"x" : i})
+    return n / (time.time() - start)
+
+def eventThroughput(n=20000):
+    '''External events processed per second by a session with a single self transition.'''
+    xml = '''
+        <scxml>
+            <datamodel>
+                <data id="n" expr="0" />
+            </datamodel>
+            <state id="s">
+                <transition event="position.update">
+                    <assign location="n" expr="n + 1" />
+                </transition>
+            </state>
+        </scxml>
+    '''
+    sm = StateMachine(xml, quantum_events=None)
+    sm.start_threaded()
+    start = time.time()
+    for i in xrange(n):
+        sm._send("position.update", {"x" : i})
+    while sm.datamodel["n"] < n:
+        eventlet.greenthread.sleep()
+    elapsed = time.time() - start
+    sm.cancel()
+    return n / elapsed
+
+def sessionChurn(n=2000):
+    '''Sessions created, run to completion and removed per second by a MultiSession.'''
+    xml = '''
+        <scxml>
+            <state id="s">
+                <invoke id="i">
+                    <content>
+                        <scxml>
+                            <final id="f" />
+                        </scxml>
+                    </content>
+                </invoke>
+                <transition event="done.invoke.i" target="f" />
+            </state>
+            <final id="f" />
+        </scxml>
+    '''
+    ms = MultiSession()
+    start = time.time()
+    for i in xrange(n):
+        ms.make_session("session%s" % i, xml).start_threaded()
+    while len(ms.sm_mapping):
+        eventlet.greenthread.sleep()
+    return n / (time.time() - start)
+
+def wireFormat(content_type, n=10000):
+    '''SCXML messages encoded and decoded per second, and the size of a message, in the encoding of content_type.'''
+    data = {"x" : 1, "y" : 2.5, "tags" : ["a", "b"], "content" : "text"}
+    start = time.time()
+    for i in xrange(n):
+        message, type = Processor.encode("position.update", "http://localhost:8081/s/scxml", data, 
+                                         "http://localhost:8082/t/scxml", "send%s" % i, content_type=content_type)
+        if type == JSON_CONTENT_TYPE:
+            Processor.fromjson(message)
+        else:
+            Processor.fromxml(message)
+    return n / (time.time() - start), len(message)
+
+def ingressLatency(n=50, **kwargs):
+    '''
+    The mean seconds from a request reaching PySCXMLServer.request_handler until 
+    its event has been processed, and until the request has been answered. 
+    kwargs are passed to the PySCXMLServer.
+    '''
+    xml = '''
+        <scxml>
+            <datamodel>
+                <data id="n" expr="0" />
+            </datamodel>
+            <state id="s">
+                <transition event="e">
+                    <assign location="n" expr="n + 1" />
+                </transition>
+            </state>
+        </scxml>
+    '''
+    server = PySCXMLServer("localhost", 8081, default_scxml_source=xml, **kwargs)
+    sm = server.init_session("s")
+    body = Processor.tojson("e", "http://localhost:8081/s/scxml", {})
+    processed = answered = 0
+    for i in xrange(n):
+        environ = {"PATH_INFO" : "/s/scxml", "REQUEST_METHOD" : "POST", "CONTENT_TYPE" : JSON_CONTENT_TYPE, 
+                   "CONTENT_LENGTH" : len(body), "wsgi.input" : StringIO(body)}
+        start = time.time()
+        server.request_handler(environ, lambda status, headers: None)
+        answered += time.time() - start
+        while sm.datamodel["n"] <= i:
+            eventlet.greenthread.sleep()
+        processed += time.time() - start
+    sm.cancel()
+    return processed / n, answered / n
+
+
+if __name__ == '__main__':
+    print "Event size: %s bytes" % eventSize()
+    print "Event allocation: %.0f events/s" % eventAllocation()
+    print "Event throughput: %.0f events/s" % eventThroughput()
+    print "Session churn: %.0f sessions/s" % sessionChurn()
+    for name, content_type in (("XML", XML_CONTENT_TYPE), ("JSON", JSON_CONTENT_TYPE)):
+        print "%s messages: %.0f round trips/s, %s bytes" % ((name,) + wireFormat(content_type))
+    print "Ingress latency: %.6f s until processed, %.6f s until answered" % ingressLatency()
+    print "Ingress latency, acked after the macrostep: %.6f s until processed, %.6f s until answered" % \
+        ingressLatency(ack_after_macrostep=True)
+    try:
+        from louie import dispatcher
+        print "Louie connections: %s" % len(dispatcher.connections)
+    except ImportError:
+        pass
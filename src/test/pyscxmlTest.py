@@ -19,10 +19,21 @@ This file is part of pyscxml.
 import eventlet 
 import time
 import unittest
-from scxml.pyscxml import StateMachine, MultiSession
+from scxml.pyscxml import StateMachine, MultiSession, custom_executable
 import os, sys
 import logging
 from scxml.errors import ScriptFetchError
+from scxml.eventqueue import EventQueue, Full
+from scxml.interpreter import CancelEvent
+from scxml.eventprocessor import Event, SCXMLEventProcessor as Processor, XML_CONTENT_TYPE, JSON_CONTENT_TYPE, isExactJson
+from scxml.logsink import LogSink, MemorySink
+from scxml.profiler import Profiler
+from scxml.tracer import Tracer
+from scxml.pyscxml_server import PySCXMLServer
+from scxml.watchdog import Watchdog
+from scxml.offload import pools
+from scxml.messaging import HttpSender, UrlGetter, SendBatcher
+from scxml import messaging
 import glob
 import traceback
      
@@ -103,6 +114,1000 @@ class RegressionTest(unittest.TestCase):
         
 
 
+    def testSignals(self):
+        from louie import dispatcher
+        from scxml import signals
+        os.environ["PYSCXMLPATH"] = "../../unittest_xml:./unittest_xml"
+        exits = []
+        louieExits = []
+        def onLouieExit(sender, final):
+            louieExits.append(final)
+        sm = StateMachine("factorial.xml")
+        sm.connect("signal_exit", lambda sender, final: exits.append(final))
+        # listeners connected through louie, as in earlier versions, still get the signals.
+        dispatcher.connect(onLouieExit, "signal_exit", sm)
+        try:
+            sm.start()
+        finally:
+            dispatcher.disconnect(onLouieExit, "signal_exit", sm)
+        self.assertEquals(exits, ["result"])
+        self.assertEquals(louieExits, ["result"])
+        self.assert_(signals.louieWarned)
+    
+    def testSessionLoggers(self):
+        os.environ["PYSCXMLPATH"] = "../../unittest_xml:./unittest_xml"
+        sm = StateMachine("factorial.xml")
+        sm.start()
+        # sessions log through shared loggers, so none are created per session.
+        self.assertFalse(any(sm.sessionid in name for name in logging.Logger.manager.loggerDict))
+    
+    def testProfiler(self):
+        os.environ["PYSCXMLPATH"] = "../../unittest_xml:./unittest_xml"
+        profiler = Profiler()
+        sm = StateMachine("factorial.xml", profiler=profiler)
+        sm.start()
+        self.assertEquals(sm.datamodel['fac'], 720)
+        counts = dict(((c["kind"], c["state"], c["line"]), c["count"]) for c in profiler.getSnapshot())
+        self.assertEquals(counts[("onentry", "loop", 7)], 1)
+        self.assertEquals(counts[("transition", "loop", 9)], 5)
+        self.assertEquals(counts[("cond", "loop", 9)], 6)
+        self.assertEquals(counts[("transition", "loop", 13)], 1)
+    
+    def testTracer(self):
+        os.environ["PYSCXMLPATH"] = "../../unittest_xml:./unittest_xml"
+        tracer = Tracer(capacity=20)
+        sm = StateMachine("factorial.xml", tracer=tracer)
+        sm.start()
+        self.assertEquals(sm.datamodel['fac'], 720)
+        self.assertEquals(len(tracer.spans), 20)
+        names = set(e["name"] for e in tracer.getEvents() if e["ph"] == "X")
+        self.assertEquals(names, set(["macrostep", "microstep", "exitStates", "executeTransitionContent", 
+                                      "enterStates", "transition", "cond"]))
+    
+    def testQuantum(self):
+        counter = '''
+            <scxml>
+                <datamodel>
+                    <data id="n" expr="0" />
+                </datamodel>
+                <state id="s">
+                    <transition event="e">
+                        <assign location="n" expr="n + 1" />
+                    </transition>
+                </state>
+            </scxml>
+        '''
+        for quantum, processed in ((1, 1), (None, 10)):
+            with StateMachine(counter, quantum_events=quantum) as sm:
+                for i in range(10):
+                    sm._send("e")
+                eventlet.greenthread.sleep()
+                self.assertEquals(sm.datamodel["n"], processed)
+                self.assertEquals(sm.interpreter.getQuantumStats()["exhausted"], int(quantum == 1))
+        
+        # a macrostep longer than quantum_time uses up the quantum it started.
+        slow = counter.replace('<assign location="n" expr="n + 1" />', 
+                               '<assign location="n" expr="n + 1" /><script>import time; time.sleep(0.03)</script>')
+        with StateMachine(slow, quantum_events=None, quantum_time=20) as sm:
+            for i in range(3):
+                sm._send("e")
+            eventlet.greenthread.sleep()
+            self.assertEquals(sm.datamodel["n"], 1)
+            self.assertEquals(sm.interpreter.getQuantumStats()["exhausted"], 1)
+    
+    def testQueueBounds(self):
+        counter = '''
+            <scxml>
+                <datamodel>
+                    <data id="n" expr="0" />
+                </datamodel>
+                <state id="s">
+                    <transition event="e">
+                        <assign location="n" expr="n + 1" />
+                    </transition>
+                </state>
+            </scxml>
+        '''
+        with StateMachine(counter, quantum_events=None, queue_options={"maxsize" : 2, "policy" : "drop_oldest"}) as sm:
+            for i in range(5):
+                sm._send("e")
+            eventlet.greenthread.sleep()
+            self.assertEquals(sm.datamodel["n"], 2)
+            self.assertEquals(sm.interpreter.externalQueue.getStats()["dropped"], 3)
+        
+        with StateMachine(counter, queue_options={"maxsize" : 1, "policy" : "error"}) as sm:
+            sm._send("e")
+            self.assertRaises(Full, sm._send, "e")
+        
+        # objects that aren't events can't be dropped.
+        queue = EventQueue(maxsize=1, policy="drop_oldest")
+        queue.put(CancelEvent())
+        self.assertRaises(Full, queue.put, Event("e"))
+        self.assertEquals((queue.qsize(), queue.getStats()["dropped"]), (1, 0))
+    
+    def testQueuePriorities(self):
+        recorder = '''
+            <scxml>
+                <datamodel>
+                    <data id="names" expr="[]" />
+                </datamodel>
+                <state id="s">
+                    <transition event="*">
+                        <script>names.append(_event.name)</script>
+                    </transition>
+                </state>
+            </scxml>
+        '''
+        options = {"priorities" : {"high" : 1, "low" : -1}}
+        with StateMachine(recorder, quantum_events=None, queue_options=options) as sm:
+            for name in ("low.1", "e.1", "high", "e.2", "low.2"):
+                sm._send(name)
+            eventlet.greenthread.sleep()
+            self.assertEquals(sm.datamodel["names"], ["high", "e.1", "e.2", "low.1", "low.2"])
+        
+        queue = EventQueue(deadlines={"stale" : -1}, expired="error")
+        queue.put(Event("stale"))
+        queue.put(Event("fresh"))
+        self.assertEquals(queue.get().name, "error.platform.deadline")
+        self.assertEquals(queue.get().name, "fresh")
+    
+    def testQueueCoalescing(self):
+        recorder = '''
+            <scxml>
+                <datamodel>
+                    <data id="names" expr="[]" />
+                    <data id="payloads" expr="[]" />
+                </datamodel>
+                <state id="s">
+                    <transition event="*">
+                        <script>names.append(_event.name); payloads.append(_event.data)</script>
+                    </transition>
+                </state>
+            </scxml>
+        '''
+        options = {"coalesce" : {"pos" : "count", "conf" : "merge"}}
+        with StateMachine(recorder, quantum_events=None, queue_options=options) as sm:
+            for name, data in (("pos", {"x" : 1}), ("conf", {"a" : 1}), ("pos", {"x" : 2}), 
+                               ("e", {}), ("conf", {"b" : 2}), ("pos", {"x" : 3})):
+                sm._send(name, data)
+            eventlet.greenthread.sleep()
+            self.assertEquals(sm.datamodel["names"], ["pos", "conf", "e"])
+            self.assertEquals(sm.datamodel["payloads"], [{"x" : 3, "count" : 3}, {"a" : 1, "b" : 2}, {}])
+            self.assertEquals(sm.interpreter.externalQueue.getStats()["coalesced"], 3)
+        
+        # a counted event has the same shape whether or not others were collapsed into it.
+        with StateMachine(recorder, queue_options=options) as sm:
+            for data in ({"x" : 1}, "a", "b"):
+                sm._send("pos", data)
+                if data != "a":
+                    eventlet.greenthread.sleep()
+            self.assertEquals(sm.datamodel["payloads"], [{"x" : 1, "count" : 1}, {"data" : "b", "count" : 2}])
+            sm._send("pos", "c")
+            eventlet.greenthread.sleep()
+            self.assertEquals(sm.datamodel["payloads"][-1], {"data" : "c", "count" : 1})
+    
+    def testEventlessConditions(self):
+        xml = '''
+            <scxml>
+                <datamodel>
+                    <data id="n" expr="0" />
+                    <data id="l" expr="[]" />
+                </datamodel>
+                <parallel id="p">
+                    <state id="counter">
+                        <transition cond="n &lt; 3" target="counter">
+                            <assign location="n" expr="n + 1" />
+                        </transition>
+                    </state>
+                    <state id="guarded">
+                        <onexit>
+                            <log label="n" expr="n" />
+                        </onexit>
+                        <transition cond="n == 3 and len(l) == 1" target="f" />
+                        <transition event="append">
+                            <script>l.append(1)</script>
+                        </transition>
+                    </state>
+                </parallel>
+                <final id="f" />
+            </scxml>
+        '''
+        sink = MemorySink()
+        with StateMachine(xml, log_sink=sink) as sm:
+            self.assertEquals(sm.datamodel["n"], 3)
+            self.assertFalse(sm.isFinished())
+            sm.send("append")
+            eventlet.greenthread.sleep()
+            self.assert_(sm.isFinished())
+        eventlet.greenthread.sleep()
+        self.assertEquals([(r.sessionid, r.state, r.label, r.value) for r in sink.records], 
+                          [(sm.sessionid, "guarded", "n", i) for i in range(4)])
+        
+    
+    def testLogSinkInvoke(self):
+        xml = '''
+            <scxml>
+                <state id="s">
+                    <invoke id="child" type="scxml">
+                        <content>
+                            <scxml>
+                                <final id="childFinal">
+                                    <onentry>
+                                        <log label="child" expr="1" />
+                                    </onentry>
+                                </final>
+                            </scxml>
+                        </content>
+                    </invoke>
+                    <transition event="done.invoke.child" target="f" />
+                </state>
+                <final id="f">
+                    <onentry>
+                        <log label="parent" expr="2" />
+                    </onentry>
+                </final>
+            </scxml>
+        '''
+        sink = MemorySink()
+        sm = StateMachine(xml, log_sink=sink)
+        sm.start_threaded()
+        eventlet.greenthread.sleep(0.1)
+        self.assert_(sm.isFinished())
+        eventlet.greenthread.sleep()
+        self.assertEquals([(r.sessionid, r.label, r.value) for r in sink.records], 
+                          [(sm.sessionid + ".child", "child", 1), (sm.sessionid, "parent", 2)])
+        self.assertRaises(NotImplementedError, LogSink().write, [])
+        
+    
+    def testLogSinkSnapshot(self):
+        xml = '''
+            <scxml>
+                <datamodel>
+                    <data id="items" expr="[]" />
+                </datamodel>
+                <state id="s">
+                    <onentry>
+                        <log label="before" expr="items" />
+                        <script>items.append(1)</script>
+                        <log label="after" expr="items" />
+                    </onentry>
+                </state>
+            </scxml>
+        '''
+        sink = MemorySink()
+        with StateMachine(xml, log_sink=sink) as sm:
+            eventlet.greenthread.sleep()
+            # a record holds the value as it was logged, not as it is when written.
+            self.assertEquals([(r.label, r.value) for r in sink.records], [("before", []), ("after", [1])])
+    
+    def testDiscardUnusedEvents(self):
+        xml = '''
+            <scxml>
+                <state id="s">
+                    <transition event="e" target="f" />
+                </state>
+                <final id="f" />
+            </scxml>
+        '''
+        # events are queued unless the session is asked to discard them.
+        with StateMachine(xml) as sm:
+            sm.send("noise")
+            self.assertEquals(sm.interpreter.discardedEvents, 0)
+        with StateMachine(xml, discard_unused_events=True) as sm:
+            for i in range(3):
+                sm.send("noise")
+            self.assertEquals(sm.interpreter.discardedEvents, 3)
+            self.assertEquals(sm.interpreter.externalQueue.received, 0)
+            sm.send("e.sub")
+            eventlet.greenthread.sleep()
+            self.assert_(sm.isFinished())
+        ms = MultiSession(init_sessions={"session1" : xml}, discard_unused_events=True)
+        self.assert_(ms["session1"].interpreter.discardUnusedEvents)
+    
+    def testConditionMemo(self):
+        xml = '''
+            <scxml>
+                <datamodel>
+                    <data id="x" expr="0" />
+                    <data id="calls" expr="[]" />
+                    <data id="f" expr="lambda: calls.append(1) or False" />
+                </datamodel>
+                <parallel id="p">
+                    <state id="a">
+                        <transition event="e" cond="x &gt; 0" target="f" />
+                        <transition event="e" cond="f()" target="f" />
+                    </state>
+                    <state id="b">
+                        <transition event="e" cond="x &gt; 0" target="f" />
+                        <transition event="e" cond="f()" target="f" />
+                    </state>
+                </parallel>
+                <final id="f" />
+            </scxml>
+        '''
+        with StateMachine(xml) as sm:
+            sm.send("e")
+            eventlet.greenthread.sleep()
+            # the pure cond was evaluated once, the one with a side effect by each transition.
+            self.assertEquals(sm.interpreter.getConditionStats()["hits"], 1)
+            self.assertEquals(sm.interpreter.getConditionStats()["misses"], 1)
+            self.assertEquals(len(sm.datamodel["calls"]), 2)
+            sm.datamodel["x"] = 1
+            sm.send("e")
+            eventlet.greenthread.sleep()
+            self.assert_(sm.isFinished())
+    
+    def testWatchdog(self):
+        xml = '''
+            <scxml>
+                <datamodel>
+                    <data id="error" expr="None" />
+                </datamodel>
+                <state id="s">
+                    <onentry>
+                        <script>
+                            import time
+                            time.sleep(0.3)
+                        </script>
+                    </onentry>
+                    <transition event="error.execution.*" target="f">
+                        <assign location="error" expr="_event.name" />
+                    </transition>
+                </state>
+                <final id="f" />
+            </scxml>
+        '''
+        watchdog = Watchdog(threshold=0.1, timeout_error=True)
+        try:
+            sm = StateMachine(xml, watchdog=watchdog)
+            sm.start()
+        finally:
+            watchdog.stop()
+        self.assert_(sm.isFinished())
+        self.assertEquals(sm.datamodel["error"], "error.execution.timeout")
+        self.assertEquals(len(watchdog.reports), 1)
+        report = watchdog.reports[0]
+        self.assertEquals((report["session"], report["kind"], report["line"]), (sm.sessionid, "script", 8))
+        # the innermost frame is the time.sleep(0.3) line of the script, run by the datamodel.
+        stack = report["stack"].rstrip().splitlines()
+        self.assertEquals(stack[-1].strip(), 'File "<string>", line 3, in <module>')
+        self.assert_(stack[-3].strip().endswith("in execExpr"))
+        
+        # the activities of a greenthread that dies inside them are forgotten.
+        def killed():
+            watchdog.enter("script", sm.sessionid, 1)
+        gt = eventlet.spawn(killed)
+        gt.wait()
+        self.assertEquals(len(watchdog.active), 1)
+        watchdog.check()
+        self.assertEquals(watchdog.active, {})
+    
+    def testOffload(self):
+        @custom_executable("http://example.org/offload", offload=True, pool_size=1)
+        def double(node, data):
+            time.sleep(0.05)
+            # the function gets copies, which the session doesn't see.
+            data["l"].append(node.getparent())
+            return int(node.get("n")) * 2 + len(data["l"])
+        
+        xml = '''
+            <scxml xmlns:o="http://example.org/offload">
+                <datamodel>
+                    <data id="l" expr="[1]" />
+                    <data id="r" expr="None" />
+                    <data id="error" expr="None" />
+                </datamodel>
+                <state id="s">
+                    <onentry>
+                        <o:double n="20" namelist="l" />
+                    </onentry>
+                    <transition event="done.executable.double" target="t">
+                        <assign location="r" expr="_event.data" />
+                    </transition>
+                </state>
+                <state id="t">
+                    <onentry>
+                        <o:double n="x" namelist="l" />
+                    </onentry>
+                    <transition event="error.execution" target="f">
+                        <assign location="error" expr="_event.data" />
+                    </transition>
+                </state>
+                <final id="f" />
+            </scxml>
+        '''
+        sm = StateMachine(xml)
+        sm.start()
+        self.assert_(sm.isFinished())
+        self.assertEquals(sm.datamodel["r"], 42)
+        self.assertEquals(sm.datamodel["l"], [1])
+        self.assertEquals(sm.datamodel["error"], "invalid literal for int() with base 10: 'x'")
+        stats = pools["http://example.org/offload"].getStats()
+        self.assertEquals((stats["completed"], stats["failed"], stats["running"]), (1, 1, 0))
+    
+    def testHttpSender(self):
+        from eventlet import wsgi
+        import socket
+        received = []
+        def app(environ, start_response):
+            body = environ["wsgi.input"].read()
+            received.append((environ["REMOTE_PORT"], body))
+            if body == "slow":
+                eventlet.greenthread.sleep(0.2)
+            if body == "flaky" and [b for p, b in received].count("flaky") == 1:
+                start_response("503 Service Unavailable", [("Content-Type", "text/plain")])
+                return [""]
+            start_response("200 OK", [("Content-Type", "text/plain")])
+            return ["echo " + body]
+        listener = eventlet.listen(("127.0.0.1", 0))
+        url = "http://127.0.0.1:%s/" % listener.getsockname()[1]
+        server = eventlet.spawn(wsgi.server, listener, app, log_output=False)
+        
+        sender = HttpSender(size=2, backoff=0.01)
+        results = []
+        for body in ["0", "1", "2", "3", "4", "flaky"]:
+            sender.send(url, body, callback=lambda *result: results.append(result))
+        results_from_getter = []
+        getter = UrlGetter()
+        getter.connect(UrlGetter.HTTP_RESULT, lambda sender, **kwargs: results_from_getter.append(kwargs["result"]))
+        getter.get_async(url, {"a" : "1"})
+        while len(results) < 6 or not results_from_getter:
+            eventlet.greenthread.sleep(0.01)
+        
+        self.assertEquals(sorted(results), [(200, "echo " + body, None) for body in ["0", "1", "2", "3", "4", "flaky"]])
+        self.assertEquals(results_from_getter, ["echo a=1"])
+        stats = sender.getStats()
+        self.assertEquals((stats["requests"], stats["retried"], stats["errors"]), (6, 1, 0))
+        # the requests of the sender were made over its two connections.
+        self.assertEquals(len(set(port for port, body in received if body != "a=1")), 2)
+        
+        # a request that timed out once written isn't made again, and a malformed 
+        # url is reported to the callback without taking down the worker.
+        sender = HttpSender(size=1, backoff=0.01, timeout=0.05)
+        results = []
+        sender.send(url, "slow", callback=lambda *result: results.append(result))
+        sender.send("http://127.0.0.1:abc/", "0", callback=lambda *result: results.append(result))
+        while len(results) < 2:
+            eventlet.greenthread.sleep(0.01)
+        server.kill()
+        self.assertEquals([(code, body) for code, body, exception in results], [(None, None)] * 2)
+        self.assert_(isinstance(results[0][2], socket.timeout))
+        self.assert_(isinstance(results[1][2], ValueError))
+        self.assertEquals([b for p, b in received].count("slow"), 1)
+        stats = sender.getStats()
+        self.assertEquals((stats["workers"], stats["retried"], stats["errors"]), (1, 0, 2))
+    
+    def testHttpSenderIdleClose(self):
+        # a server that keeps a connection open after answering, then closes it while idle.
+        listener = eventlet.listen(("127.0.0.1", 0))
+        url = "http://127.0.0.1:%s/" % listener.getsockname()[1]
+        connections = []
+        def handle(sock):
+            request = ""
+            while "\r\n\r\n" not in request:
+                request += sock.recv(4096)
+            headers, body = request.split("\r\n\r\n", 1)
+            length = int([line.split(":")[1] for line in headers.split("\r\n") if line.lower().startswith("content-length")][0])
+            while len(body) < length:
+                body += sock.recv(4096)
+            sock.sendall("HTTP/1.1 200 OK\r\nContent-Length: %s\r\n\r\n%s" % (len(body), body))
+            eventlet.greenthread.sleep(0.05)
+            sock.close()
+        def serve():
+            while True:
+                sock, addr = listener.accept()
+                connections.append(addr)
+                eventlet.spawn(handle, sock)
+        server = eventlet.spawn(serve)
+        
+        sender = HttpSender(size=1, retries=0)
+        results = []
+        sender.send(url, "first", callback=lambda *result: results.append(result))
+        while not results:
+            eventlet.greenthread.sleep(0.01)
+        eventlet.greenthread.sleep(0.1)
+        sender.send(url, "second", callback=lambda *result: results.append(result))
+        while len(results) < 2:
+            eventlet.greenthread.sleep(0.01)
+        server.kill()
+        # the second request was made again on a new connection, although retries is 0.
+        self.assertEquals(results, [(200, "first", None), (200, "second", None)])
+        self.assertEquals(len(connections), 2)
+        stats = sender.getStats()
+        self.assertEquals((stats["retried"], stats["errors"], stats["connections"]), (1, 0, 1))
+    
+    def testUrlGetterRedirect(self):
+        from eventlet import wsgi
+        def app(environ, start_response):
+            if environ["PATH_INFO"] == "/old":
+                start_response("302 Found", [("Location", "/new"), ("Content-Type", "text/plain")])
+                return [""]
+            start_response("200 OK", [("Content-Type", "text/plain")])
+            return ["moved"]
+        listener = eventlet.listen(("127.0.0.1", 0))
+        url = "http://127.0.0.1:%s/" % listener.getsockname()[1]
+        server = eventlet.spawn(wsgi.server, listener, app, log_output=False)
+        results = []
+        getter = UrlGetter()
+        getter.connect(UrlGetter.HTTP_RESULT, lambda sender, **kwargs: results.append(kwargs["result"]))
+        getter.get_async(url + "old", {"a" : "1"})
+        for _ in range(100):
+            if results: break
+            eventlet.greenthread.sleep(0.01)
+        server.kill()
+        self.assertEquals(results, ["moved"])
+        
+        # requests that should go through a proxy are left to urllib2.
+        environ = dict(os.environ)
+        try:
+            os.environ["http_proxy"] = "http://proxy.example.org:3128"
+            os.environ["no_proxy"] = "localhost"
+            self.assert_(messaging.usesProxy("http://example.org/"))
+            self.assertFalse(messaging.usesProxy("http://localhost/"))
+            self.assertFalse(messaging.usesProxy("https://example.org/"))
+        finally:
+            os.environ.clear()
+            os.environ.update(environ)
+    
+    def testSendBatcher(self):
+        from eventlet import wsgi
+        receiver = '''
+            <scxml>
+                <state id="s0">
+                    <transition event="e0" target="s1" />
+                </state>
+                <state id="s1">
+                    <transition event="e1" target="s2" />
+                </state>
+                <state id="s2">
+                    <transition event="e2" target="s3" />
+                </state>
+                <state id="s3">
+                    <transition event="e3" target="s4" />
+                </state>
+                <state id="s4">
+                    <transition event="e4" target="f" />
+                </state>
+                <final id="f" />
+            </scxml>
+        '''
+        listener = eventlet.listen(("127.0.0.1", 0))
+        port = listener.getsockname()[1]
+        server = PySCXMLServer("127.0.0.1", port, default_scxml_source=receiver)
+        http = eventlet.spawn(wsgi.server, listener, server.request_handler, log_output=False)
+        
+        sender = '''
+            <scxml>
+                <state id="s">
+                    <onentry>
+                        %s
+                    </onentry>
+                </state>
+            </scxml>
+        ''' % "".join('<send event="e%s" target="http://127.0.0.1:%s/r1/scxml" />' % (n, port) for n in range(5))
+        batcher = messaging.sendBatcher = SendBatcher(window=0.05, maxsize=3)
+        try:
+            sm = StateMachine(sender)
+            sm.start_threaded()
+            r1 = None
+            for _ in range(100):
+                # the session is removed from the server when it exits.
+                r1 = r1 or server.get("r1")
+                if r1 and r1.isFinished(): break
+                eventlet.greenthread.sleep(0.02)
+            sm.cancel()
+        finally:
+            messaging.sendBatcher = None
+            http.kill()
+        # the events arrived in order, in a full batch followed by one sent after the window.
+        self.assert_(r1 and r1.isFinished())
+        self.assertEquals((batcher.batchCount, batcher.messageCount), (2, 5))
+    
+    def testSendBatcherJson(self):
+        from eventlet import wsgi
+        receiver = '''
+            <scxml>
+                <datamodel>
+                    <data id="received" expr="None" />
+                </datamodel>
+                <state id="s0">
+                    <transition event="e0" target="s1" />
+                </state>
+                <state id="s1">
+                    <transition event="e1" target="s2" />
+                </state>
+                <state id="s2">
+                    <transition event="e2" target="s3" />
+                </state>
+                <state id="s3">
+                    <transition event="e3" target="s4" />
+                </state>
+                <state id="s4">
+                    <transition event="e4" target="f">
+                        <assign location="received" expr="_event" />
+                    </transition>
+                </state>
+                <final id="f" />
+            </scxml>
+        '''
+        listener = eventlet.listen(("127.0.0.1", 0))
+        port = listener.getsockname()[1]
+        server = PySCXMLServer("127.0.0.1", port, default_scxml_source=receiver)
+        http = eventlet.spawn(wsgi.server, listener, server.request_handler, log_output=False)
+        
+        sender = '''
+            <scxml>
+                <state id="s">
+                    <onentry>
+                        %s
+                        <send event="e4" target="http://127.0.0.1:%s/r1/scxml" id="last">
+                            <param name="text" expr="'abc'" />
+                            <param name="list" expr="[1, 2.5, None]" />
+                        </send>
+                    </onentry>
+                </state>
+            </scxml>
+        ''' % ("".join('<send event="e%s" target="http://127.0.0.1:%s/r1/scxml" />' % (n, port) for n in range(4)), port)
+        batcher = messaging.sendBatcher = SendBatcher(window=0.05, maxsize=3)
+        flushed = []
+        flush = batcher.flush
+        batcher.flush = lambda key: flushed.append(key[1]) or flush(key)
+        messaging.scxmlContentType = JSON_CONTENT_TYPE
+        try:
+            sm = StateMachine(sender)
+            sm.start_threaded()
+            r1 = None
+            for _ in range(100):
+                # the session is removed from the server when it exits.
+                r1 = r1 or server.get("r1")
+                if r1 and r1.isFinished(): break
+                eventlet.greenthread.sleep(0.02)
+            sm.cancel()
+        finally:
+            messaging.sendBatcher = None
+            messaging.scxmlContentType = XML_CONTENT_TYPE
+            http.kill()
+        # the events arrived in order, in JSON, in a full batch followed by one sent after the window.
+        self.assert_(r1 and r1.isFinished())
+        self.assertEquals((batcher.batchCount, batcher.messageCount), (2, 5))
+        self.assertEquals(flushed, [JSON_CONTENT_TYPE] * 2)
+        event = r1.datamodel["received"]
+        self.assertEquals(event.data, {"text" : "abc", "list" : [1, 2.5, None]})
+        self.assertEquals(map(type, event.data.keys() + [event.data["text"], event.origin, event.sendid]), [str] * 5)
+        self.assertEquals(event.sendid, "last")
+    
+    def testWireFormat(self):
+        data = {"a" : [1, "b"], "content" : "text"}
+        message, contentType = Processor.encode("e.f", "http://target", data, "http://origin", "id1", 
+                                                content_type=JSON_CONTENT_TYPE)
+        self.assertEquals(contentType, JSON_CONTENT_TYPE)
+        self.assert_("\n" not in message)
+        events = Processor.fromjson(message + "\n" + message)
+        self.assertEquals(len(events), 2)
+        event = events[0]
+        self.assertEquals((event.name, event.origin, event.sendid, event.data), ("e.f", "http://origin", "id1", data))
+        self.assertEquals(event.tokens, ("e", "f"))
+        self.assertEquals(map(type, [event.origin, event.sendid, event.data.keys()[0], event.data["content"]]), [str] * 4)
+        # data that can't be written as JSON, or wouldn't be read back the same, is sent as XML.
+        self.assertFalse(isExactJson({1 : "a"}))
+        for data in [{"a" : object}, {"a" : (1, 2)}, {"a" : u"b"}, {"a" : float("nan")}]:
+            message, contentType = Processor.encode("e", "http://target", data, 
+                                                    content_type=JSON_CONTENT_TYPE)
+            self.assertEquals(contentType, XML_CONTENT_TYPE)
+            self.assertEquals(repr(Processor.fromxml(message).data), repr(data))
+    
+    def testStream(self):
+        from eventlet import wsgi
+        import json
+        xml = '''
+            <scxml>
+                <state id="s0">
+                    <transition event="e0" target="s1" />
+                </state>
+                <state id="s1">
+                    <transition event="e1" target="s2" />
+                </state>
+                <state id="s2">
+                    <transition event="e2" target="f" />
+                </state>
+                <final id="f" />
+            </scxml>
+        '''
+        listener = eventlet.listen(("127.0.0.1", 0))
+        port = listener.getsockname()[1]
+        # streaming is off unless asked for.
+        response = []
+        PySCXMLServer("127.0.0.1", port, default_scxml_source=xml).request_handler({"PATH_INFO" : "/_pyscxml/stream"}, 
+                                                                                   lambda status, headers: response.append(status))
+        self.assertEquals(response, ["404 NOT FOUND"])
+        server = PySCXMLServer("127.0.0.1", port, default_scxml_source=xml, stream=True)
+        http = eventlet.spawn(wsgi.server, listener, server.request_handler, log_output=False)
+        sessions = {}
+        for sessionid in ("a", "b"):
+            sessions[sessionid] = server.init_session(sessionid)
+        
+        sock = eventlet.connect(("127.0.0.1", port))
+        sock.sendall("POST /_pyscxml/stream HTTP/1.1\r\nHost: localhost\r\nTransfer-Encoding: chunked\r\n"
+                     "Content-Type: %s\r\n\r\n" % JSON_CONTENT_TYPE)
+        received = []
+        def acks():
+            return [json.loads(line) for line in "".join(received).splitlines() if line.startswith("{")]
+        def write(line):
+            sock.sendall("%x\r\n%s\r\n" % (len(line), line))
+        
+        write(json.dumps({"session" : "a", "name" : "e0"}) + "\n")
+        # the acknowledgement comes back while the request goes on.
+        while not acks():
+            received.append(sock.recv(4096))
+        lines = [json.dumps({"session" : "b", "name" : "e0"}), 
+                 json.dumps({"session" : "a", "name" : "e1", "data" : {"x" : 1}}),
+                 "not json",
+                 json.dumps({"session" : "b", "name" : "e1"}),
+                 json.dumps({"session" : "a", "name" : "e2"}),
+                 json.dumps({"session" : "b", "name" : "e2"})]
+        # several lines in a chunk, and a line split over two chunks.
+        write("\n".join(lines[:3]) + "\n" + lines[3][:5])
+        write(lines[3][5:] + "\n" + "\n".join(lines[4:]) + "\n")
+        sock.sendall("0\r\n\r\n")
+        while len(acks()) < 7:
+            received.append(sock.recv(4096))
+        sock.close()
+        http.kill()
+        
+        acks = acks()
+        self.assertEquals([ack["line"] for ack in acks], range(1, 8))
+        self.assertEquals([ack.get("ok", False) for ack in acks], [True] * 3 + [False] + [True] * 3)
+        for _ in range(50):
+            if all(sm.isFinished() for sm in sessions.values()): break
+            eventlet.greenthread.sleep(0.02)
+        self.assert_(all(sm.isFinished() for sm in sessions.values()))
+    
+    def testIngress(self):
+        from StringIO import StringIO
+        xml = '''
+            <scxml>
+                <datamodel>
+                    <data id="seen" expr="[]" />
+                </datamodel>
+                <state id="s">
+                    <transition event="e">
+                        <script>seen.append(_event.data["n"])</script>
+                    </transition>
+                    <transition event="stop" target="f" />
+                </state>
+                <final id="f" />
+            </scxml>
+        '''
+        server = PySCXMLServer("localhost", 8081, default_scxml_source=xml, ack_after_macrostep=True)
+        sm = server.init_session("s")
+        def post(name, data=None):
+            # a list of names is posted as a batch.
+            names = name if isinstance(name, list) else [name]
+            body = "\n".join(Processor.tojson(name, "", data or {}) for name in names)
+            environ = {"PATH_INFO" : "/s/scxml", "REQUEST_METHOD" : "POST", "CONTENT_TYPE" : JSON_CONTENT_TYPE, 
+                       "CONTENT_LENGTH" : len(body), "wsgi.input" : StringIO(body)}
+            response = []
+            server.request_handler(environ, lambda status, headers: response.append(status))
+            return response[0]
+        
+        # each request is answered once its event has been processed.
+        for n in range(3):
+            self.assertEquals(post("e", {"n" : n}), "200 OK")
+            self.assertEquals(sm.datamodel["seen"], range(n + 1))
+        
+        # the requests of concurrent clients are queued in the order they arrive.
+        server.ack_after_macrostep = False
+        pool = eventlet.GreenPool()
+        for n in range(3, 10):
+            pool.spawn(post, "e", {"n" : n})
+        pool.waitall()
+        server.ack_after_macrostep = True
+        self.assertEquals(post("e", {"n" : 10}), "200 OK")
+        self.assertEquals(sm.datamodel["seen"], range(11))
+        
+        queue = sm.interpreter.externalQueue
+        queue.maxsize, queue.policy = 0, "error"
+        self.assertEquals(post("e", {"n" : 11}), "503 SERVICE UNAVAILABLE")
+        self.assertEquals(sm.interpreter.acks, {})
+        # a batch that doesn't fit is refused as a whole.
+        queue.maxsize = 1
+        self.assertEquals(post(["e", "e"]), "503 SERVICE UNAVAILABLE")
+        self.assertEquals((queue.qsize(), sm.interpreter.acks), (0, {}))
+        # a request for an event the queue drops is answered at once.
+        queue.maxsize, queue.policy = 0, "drop_newest"
+        self.assertEquals(post("e", {"n" : 11}), "503 SERVICE UNAVAILABLE")
+        self.assertEquals(sm.interpreter.acks, {})
+        queue.maxsize = None
+        self.assertEquals(post("stop"), "200 OK")
+        self.assert_(sm.isFinished())
+        self.assertEquals(sm.datamodel["seen"], range(11))
+    
+    def testEventAcks(self):
+        xml = '''
+            <scxml>
+                <datamodel>
+                    <data id="seen" expr="[]" />
+                </datamodel>
+                <state id="s">
+                    <transition event="*">
+                        <script>seen.append(_event.name)</script>
+                    </transition>
+                </state>
+            </scxml>
+        '''
+        sm = StateMachine(xml, queue_options={"maxsize" : 3, "policy" : "drop_oldest", 
+                                              "coalesce" : {"c" : "latest"}, "deadlines" : {"late" : 0}})
+        interpreter = sm.interpreter
+        acks = {}
+        for name in ["dropped", "c", "coalesced", "late", "e"]:
+            event = Event("c" if name == "coalesced" else name)
+            acks[name] = interpreter.whenProcessed(event)
+            interpreter.externalQueue.put(event)
+        # dropped was dropped to make room for e.
+        self.assertEquals(acks["dropped"].wait(), None)
+        sm.start_threaded()
+        eventlet.greenthread.sleep(0.05)
+        self.assertEquals(sm.datamodel["seen"], ["c", "e"])
+        # the second c was coalesced into the first, and late expired in the queue.
+        self.assertEquals(dict((name, ack.wait()) for name, ack in acks.items()), 
+                          {"dropped" : None, "c" : True, "coalesced" : True, "late" : None, "e" : True})
+        self.assertEquals(interpreter.acks, {})
+        sm.cancel()
+    
+    def testServer(self):
+        from StringIO import StringIO
+        xml = '''
+            <scxml>
+                <state id="s">
+                    <transition event="next" target="t" />
+                </state>
+                <state id="t">
+                    <transition event="next" target="f" />
+                </state>
+                <final id="f" />
+            </scxml>
+        '''
+        server = PySCXMLServer("localhost", 8081, default_scxml_source=xml)
+        for sessionid in ("s1", "s2"):
+            server.init_session(sessionid)
+        server.send("next", to_session="s1")
+        server.send("next", to_session="s1")
+        
+        def get(path, body=None):
+            response = []
+            environ = {"PATH_INFO" : path}
+            if body is not None:
+                environ.update({"REQUEST_METHOD" : "POST", "CONTENT_TYPE" : "application/x-www-form-urlencoded", 
+                                "CONTENT_LENGTH" : len(body), "wsgi.input" : StringIO(body)})
+            output = server.request_handler(environ, lambda status, headers: response.extend([status, dict(headers)]))
+            return response[0], response[1], "".join(output)
+        
+        status, headers, output = get("/_pyscxml/metrics")
+        self.assertEquals(status, "200 OK")
+        self.assert_(headers["Content-type"].startswith("application/openmetrics-text"))
+        samples = dict(line.rsplit(" ", 1) for line in output.splitlines() if not line.startswith("#"))
+        self.assertEquals(samples["pyscxml_sessions"], "1")
+        self.assertEquals(samples["pyscxml_sessions_created_total"], "2")
+        self.assertEquals(samples["pyscxml_sessions_exited_total"], "1")
+        self.assertEquals(samples['pyscxml_session_queue_depth{session="s2"}'], "0")
+        self.assertEquals(samples["pyscxml_event_wait_seconds_count"], "2")
+        self.assertEquals(samples['pyscxml_macrostep_seconds_bucket{le="+Inf"}'], "4")
+        self.assert_(output.endswith("# EOF\n"))
+        self.assertEquals(get("/_pyscxml/other")[0], "404 NOT FOUND")
+        
+        # the paths outside of /_pyscxml/ belong to the sessions, whatever their names.
+        self.assertEquals(get("/metrics/basichttp", "_scxmleventname=next")[0], "200 OK")
+        eventlet.greenthread.sleep()
+        self.assert_(server.get("metrics").In("t"))
+        server.cancel()
+        self.assertRaises(ValueError, PySCXMLServer, "localhost", 8081, init_sessions={"_pyscxml" : xml})
+        
+
+    def testPrecompile(self):
+        os.environ["PYSCXMLPATH"] = "../../unittest_xml:./unittest_xml"
+        for name in ["colors.xml", "parallel.xml", "history.xml", "internal_transition.xml"]:
+            sm = StateMachine(name, precompile=True)
+            self.assert_(sm.doc.compiled)
+            sm.start()
+            self.assert_(sm.isFinished())
+        
+        with StateMachine("all_configs.xml", precompile=True) as sm: 
+            for event in "abcdefgh":
+                sm.send(event)
+            self.assert_(sm.isFinished())
+        
+        flat = '''
+            <scxml>
+                <state id="s1">
+                    <transition event="e" target="s2" />
+                </state>
+                <state id="s2">
+                    <transition target="f" />
+                </state>
+                <final id="f" />
+            </scxml>
+        '''
+        with StateMachine(flat, precompile=True) as sm:
+            self.assert_(sm.doc.compiled.isFlat)
+            sm.send("unknown")
+            self.assert_(sm.In("s1"))
+            sm.send("e")
+            eventlet.greenthread.sleep()
+            self.assert_(sm.isFinished())
+        
+        with MultiSession(init_sessions={"session1" : flat, "session2" : flat}, precompile=True) as ms:
+            self.assertEquals(ms.getReceivers("unknown"), [])
+            self.assertEquals(len(ms.getReceivers("e")), 2)
+            ms.send("e")
+            eventlet.greenthread.sleep()
+            self.assertEquals(len(ms.sm_mapping), 0)
+        
+        with MultiSession(init_sessions={"session1" : flat}) as ms:
+            self.assertEquals(ms.getReceivers("e.sub"), [ms["session1"]])
+            self.assertEquals(ms.getReceivers("unknown"), [])
+            ms.send("e")
+            eventlet.greenthread.sleep()
+            self.assertEquals(ms.subscriptions, {})
+        
+    def testCohortBusySessions(self):
+        xml = '''
+            <scxml>
+                <state id="s1">
+                    <transition event="a" target="s2" />
+                </state>
+                <state id="s2">
+                    <transition event="b" target="f" />
+                </state>
+                <final id="f" />
+            </scxml>
+        '''
+        ms = MultiSession(init_sessions={"session1" : xml}, precompile=True)
+        sm = ms["session1"]
+        # a session that hasn't started gets every broadcast.
+        self.assertEquals(ms.getReceivers("b"), [sm])
+        ms.start()
+        self.assertEquals(ms.getReceivers("b"), [])
+        # b can't be taken in s1, but it will be once the queued a has been processed.
+        sm.interpreter.externalQueue.put(Event("a"))
+        ms.send("b")
+        eventlet.greenthread.sleep()
+        self.assert_(sm.isFinished())
+    
+    def testFlatDatamodel(self):
+        # datamodel expressions in executable content don't keep a document off the flat path.
+        xml = '''
+            <scxml>
+                <datamodel>
+                    <data id="n" expr="0" />
+                </datamodel>
+                <state id="s1">
+                    <onexit>
+                        <assign location="n" expr="n + 1" />
+                    </onexit>
+                    <transition event="e" target="s2">
+                        <script>n = n * 10</script>
+                    </transition>
+                </state>
+                <state id="s2">
+                    <onentry>
+                        <assign location="n" expr="n + 2" />
+                    </onentry>
+                    <transition event="e" target="f" />
+                </state>
+                <final id="f" />
+            </scxml>
+        '''
+        with StateMachine(xml, precompile=True) as sm:
+            self.assert_(sm.doc.compiled.isFlat)
+            sm.send("e")
+            eventlet.greenthread.sleep()
+            self.assert_(sm.In("s2"))
+            self.assertEquals(sm.datamodel["n"], 12)
+            sm.send("e")
+            eventlet.greenthread.sleep()
+            self.assert_(sm.isFinished())
+    
+
     def testW3cPython(self):
 #        logging.basicConfig(level=logging.NOTSET)
         os.environ["PYSCXMLPATH"] = "../../w3c_tests/assertions_python"